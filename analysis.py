@@ -0,0 +1,143 @@
+"""
+State-level analysis data shared by the views of `app.py`.
+`state_analytics` joins the latest cases and deaths of every state with its population, area
+and the mean wear mask probability of its counties, then derives the ratios of the scatter and
+correlation matrices. `state_series_index` splits the state history into date-sorted arrays
+per state. Each is built once per data version of its input levels and handed out to every
+caller until one of those levels changes; views must treat them as read-only.
+"""
+import time
+import logging
+import threading
+from collections import Counter, namedtuple
+import numpy as np
+import utils
+import lookup
+import database
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+# levels `state_analytics` is built from: a new version of any other level keeps it
+STATE_ANALYTICS_LEVELS = ('covid-us-state', 'state-population', 'state-area', 'mask-use-by-county')
+RATIOS = ['CFR', 'IR', 'PD', 'WMP']      # fatality rate, infection rate, population density, WMP
+SERIES_LABELS = ('cases', 'deaths')      # columns of the state history indexed per state
+MOVING_AVERAGE_WINDOW = 7                # days of the moving average of the daily increases
+
+_lock = threading.Lock()         # one build at a time, concurrent callers wait for it
+_built = {}                      # name -> (input data versions, value) of its last build
+stats = Counter()                # values served from their last build ('hit') or built ('build')
+
+# history of one state: 'dates' sorted, 'values' (label -> cumulative count), 'daily' (label ->
+# daily increase, the first day's count for the first day) and 'average' (label -> moving
+# average of 'daily' over the next `MOVING_AVERAGE_WINDOW` days), all NumPy arrays
+StateSeries = namedtuple('StateSeries', ['dates', 'values', 'daily', 'average'])
+
+
+def wear_mask_prob(mask_use):
+    """Returns the probability of wearing a mask of every county of the mask use frame"""
+    return sum(weight * mask_use[answer.lower()]
+               for answer, weight in database.WEAR_MASK_WEIGHTS.items())
+
+
+def build_state_analytics(df_dict):
+    """Builds the analytics frame from the frames (level -> DataFrame) of a dataset, leaving them
+    unchanged: 'state', the latest 'cases' and 'deaths', population 'total', 'area',
+    'wear_mask_prob' and the `RATIOS` rounded to 3 decimals. States missing from any input, DC
+    and counties of unknown FIPS codes are left out.
+    """
+    df = df_dict['covid-us-state']
+    df = df[df.date == max(df.date)].drop(columns='date').reset_index(drop=True)
+    mask_use = df_dict['mask-use-by-county']
+    by_state = (wear_mask_prob(mask_use)
+                .groupby(lookup.map_fips(mask_use['countyfp'])['state_code'].to_numpy())
+                .mean()
+                .drop(['N/A', 'DC'], errors='ignore'))
+    wmp = by_state.rename_axis('state_code').reset_index(name='wear_mask_prob')
+    wmp.insert(0, 'state', lookup.state_names(wmp['state_code']))
+    df = (df.merge(df_dict['state-population'], on='state')
+            .merge(df_dict['state-area'], on='state')
+            .merge(wmp[['state', 'wear_mask_prob']], on='state'))
+    df['CFR'] = df['deaths'] / df['cases']
+    df['IR'] = df['cases'] / df['total']
+    df['PD'] = df['total'] / df['area']
+    df['WMP'] = df['wear_mask_prob']
+    df[RATIOS] = df[RATIOS].round(3)
+    return df
+
+
+def moving_average(daily, window_size=MOVING_AVERAGE_WINDOW):
+    """Returns `utils.moving_average(daily, window_size)` from one cumulative sum: the mean of
+    the `window_size` values starting at each position, fewer near the end
+    """
+    sums = np.concatenate([[0], np.cumsum(daily)])
+    start = np.arange(len(daily))
+    end = np.minimum(start + window_size, len(daily))
+    return (sums[end] - sums[start]) / (end - start)
+
+
+def _series(dates, columns):
+    daily = {label: np.diff(values, prepend=values.dtype.type(0)) for label, values in columns.items()}
+    return StateSeries(dates, columns, daily,
+                       {label: moving_average(values) for label, values in daily.items()})
+
+
+def build_state_series_index(df_dict):
+    """Builds the `StateSeries` of every state code of the state history with one sort, each
+    array a contiguous slice of the sorted columns
+    """
+    df = df_dict['covid-us-state']
+    codes = lookup.state_codes(df['state']).to_numpy(dtype=object)
+    dates = df['date'].to_numpy()
+    order = np.lexsort((dates, codes))
+    codes, dates = codes[order], dates[order]
+    columns = {label: df[label].to_numpy()[order] for label in SERIES_LABELS}
+    bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    return {codes[start]: _series(dates[start:end], {label: values[start:end]
+                                                     for label, values in columns.items()})
+            for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(codes)])}
+
+
+def _memoized(name, dataset, levels, build):
+    key = tuple(dataset.versions.get(level) for level in levels)
+    cached = _built.get(name)
+    if cached is not None and cached[0] == key:
+        stats['hit'] += 1
+        return cached[1]
+    with _lock:
+        cached = _built.get(name)
+        if cached is not None and cached[0] == key:
+            stats['hit'] += 1
+            return cached[1]
+        start = time.perf_counter()
+        value = build(dataset.frames)
+        _built[name] = (key, value)
+        stats['build'] += 1
+        logger.info(f"{name} built in {time.perf_counter() - start:.2f}s for versions "
+                    f"{dict(zip(levels, key))}")
+        return value
+
+
+def state_analytics(dataset):
+    """Returns the analytics frame of the `database.Dataset` `dataset`, built by
+    `build_state_analytics` only if the data version of one of `STATE_ANALYTICS_LEVELS` changed
+    since the last build. Also usable as a `DataRefresher` hook, to build it right after a swap.
+    """
+    return _memoized('state analytics', dataset, STATE_ANALYTICS_LEVELS, build_state_analytics)
+
+
+def state_series_index(dataset):
+    """Returns the state code -> `StateSeries` index of `dataset`, built by
+    `build_state_series_index` only if the data version of 'covid-us-state' changed since the
+    last build. Also usable as a `DataRefresher` hook.
+    """
+    return _memoized('state series index', dataset, ('covid-us-state',), build_state_series_index)
+
+
+def state_series(dataset, state_code):
+    """Returns the `StateSeries` of `state_code`, with empty arrays for a state without data"""
+    index = state_series_index(dataset)
+    if state_code not in index:
+        return _series(np.array([], dtype='datetime64[ns]'),
+                       {label: np.array([], dtype=np.int64) for label in SERIES_LABELS})
+    return index[state_code]
@@ -2,26 +2,25 @@
 # from jupyterlab_dash import AppViewer
 # viewer = AppViewer()
 
-from utils import get_state_codes, get_state_name, daily_increase, moving_average
-from utils import all_states, state_code_dict, state_map_dict, fip_to_county, fip_to_state
+from utils import daily_increase, moving_average
+from utils import all_states
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 
-import json
-import numpy as np
-import pandas as pd
-from functools import reduce
 from datetime import datetime
-from urllib.request import urlopen
 
 import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 
-from database import fetch_all_db_as_df
+from database import DataRefresher
+import assets
+import lookup
+import analysis
+from figure_cache import FigureCache
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
 COLORS = ['rgb(67,67,67)', 'rgb(115,115,115)', 'rgb(49,130,189)', 'rgb(189,189,189)']
@@ -43,13 +42,16 @@ colors_text = {
     "deaths": "olivedrab"
 }
 
-with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json') as response:
-    county_json = json.load(response)
-
 # Define the dash app first
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
-df_dict = fetch_all_db_as_df()
+# loads the data once (blocking), then reloads changed levels in the background
+refresher = DataRefresher()
+refresher.start()
+refresher.add_hook(analysis.state_analytics)     # rebuilt after swaps that change its inputs
+refresher.add_hook(analysis.state_series_index)
+# figures of the callbacks below, per inputs and data version, shared with the other workers
+figures = FigureCache(refresher)
 
 
 # Define component functions
@@ -151,7 +153,9 @@ def enhancement_description():
 # Defines the dependencies of interactive components
 @app.callback(Output('time-series-total', 'figure'),
              Input('target-label', 'value'))
+@figures.cached('covid-us')
 def time_series_cumulative(label):
+    df_dict = refresher.frames()
     df = df_dict['covid-us']
     x = df['date']
     trace = go.Scatter(x=x, y=df[label], mode='lines', name=label, fill='tozeroy',
@@ -172,7 +176,9 @@ def time_series_cumulative(label):
 
 @app.callback(Output('time-series-daily', 'figure'),
              Input('daily-label', 'value'))
+@figures.cached('covid-us')
 def time_series_daily(label, window_size=7):
+    df_dict = refresher.frames()
     df = df_dict['covid-us']
     x = df['date']
     daily = daily_increase(df[label])
@@ -216,21 +222,17 @@ def time_series_daily(label, window_size=7):
             Input('state-name', 'value'),
             Input('label-by-state', 'value'),
              )
+@figures.cached('covid-us-state')
 def time_series_state(plot_type='daily', state_name='Rhode Island', label='cases',):
 #     print(label, plot_type, state_name)
-    df = df_dict['covid-us-state']
-    df['state_code'] = df['state'].apply(lambda x: state_code_dict[x])
-    state_code = state_code_dict[state_name]
-    df_state = df[df.state_code == state_code]
+    series = analysis.state_series(refresher.dataset, lookup.state_code(state_name))
     state = state_name
-    df_state = df_state.sort_values(by='date')
-    df_state = pd.DataFrame(df_state, columns=df_state.columns)
-    x = df_state.date
-    y = df_state[label].values
+    x = series.dates
+    y = series.values[label]
     if plot_type == 'daily':
-        window_size = 7
-        daily_cases = daily_increase(y)
-        moving_avg = moving_average(daily_cases, window_size)
+        window_size = analysis.MOVING_AVERAGE_WINDOW
+        daily_cases = series.daily[label]
+        moving_avg = series.average[label]
         trace_bar = go.Bar(x=x, y=daily_cases, name=f'Daily new {label}',
                     marker = dict(color = colors_bar[label],
                                   line=dict(color=colors_bar[label],width=1.5),
@@ -281,11 +283,12 @@ def time_series_state(plot_type='daily', state_name='Rhode Island', label='cases
 
 @app.callback(Output('heat-map-by-state', 'figure'),
               Input('label-radioitems', 'value'))
+@figures.cached('covid-us-state')
 def heat_map(label):
     """Create the heap map of given label in US at the beginning of given month"""
+    df_dict = refresher.frames()
     df = df_dict['covid-us-state']
-    df['month'] = df.date.dt.month_name()
-    df['state_code'] = df['state'].apply(lambda x: get_state_codes(x))
+    df = df.assign(month=df.date.dt.month_name(), state_code=lookup.state_codes(df['state']))
     df_month = df[((df.date.dt.day == 1) | (df.date == max(df.date)))]
     fig = px.choropleth(df_month,
                     locations='state_code',
@@ -314,17 +317,14 @@ def heat_map(label):
 
 
 def heat_map_mask_use():
+    df_dict = refresher.frames()
     df = df_dict['mask-use-by-county']
-    df['countyfp'] = df['countyfp'].apply(lambda x: str(int(x)).zfill(5))
-    df['wear_mask_prob'] = 0.25 * df['rarely'] + 0.5 * df['sometimes'] + \
-                0.75 * df['frequently'] + 1.0 * df['always']
-    df['county'] = df.apply(lambda x: fip_to_county(x.countyfp), axis=1)
-    df['state_code'] = df.apply(lambda x: fip_to_state(x.countyfp), axis=1)
+    df = df.assign(wear_mask_prob=analysis.wear_mask_prob(df))
+    df[['county', 'state_code', 'state']] = lookup.map_fips(df['countyfp'])
     df = df.drop(df[df['state_code'] == 'N/A'].index).reset_index(drop=True)
-    df['state'] = df['state_code'].apply(lambda x: state_map_dict[x])
     fig = px.choropleth(df,
                         locations='countyfp',
-                        geojson=county_json,
+                        geojson=assets.county_geojson(),
                         scope="usa",
                         color='wear_mask_prob', # a column in the dataset
                         hover_name='state', # column to add to hover information
@@ -338,38 +338,7 @@ def heat_map_mask_use():
     return fig
 
 def scatter_matrix():
-    df = df_dict['covid-us-state']
-    df.fips = df.fips.apply(lambda x: str(x).zfill(2))
-    df = df[df.date == max(df.date)]
-    df = df.drop(columns='date', axis=1).reset_index(drop=True)
-    state_pop = df_dict['state-population']
-    state_area =  df_dict['state-area']
-
-    mask_use = df_dict['mask-use-by-county']
-    mask_use.countyfp = mask_use.countyfp.apply(lambda x: str(x).zfill(5))
-    mask_use['wear_mask_prob'] = 0.25 * mask_use['rarely'] + 0.5 * mask_use['sometimes'] + \
-                    0.75 * mask_use['frequently'] + 1.0 * mask_use['always']
-    mask_use['state_code'] = mask_use.apply(lambda x: fip_to_state(x.countyfp), axis=1)
-    mask_use['county'] = mask_use.apply(lambda x: fip_to_county(x.countyfp), axis=1)
-    df_agg = mask_use.groupby('state_code').agg(['mean'])
-    df_agg.columns = ["_".join(x) for x in np.ravel(df_agg.columns)]
-    df_agg.reset_index(inplace=True)
-    df_agg.rename(columns={'wear_mask_prob_mean' : 'wear_mask_prob'}, inplace=True)
-    df_agg = df_agg[['state_code', 'wear_mask_prob']]
-    df_agg.drop(df_agg[df_agg['state_code'] == 'N/A'].index, inplace = True)
-    df_agg.drop(df_agg[df_agg['state_code'] == 'DC'].index, inplace = True)
-    df_agg['state'] = df_agg['state_code'].apply(lambda x: state_map_dict[x])
-    df_agg = df_agg[['state', 'wear_mask_prob']]
-    data_frames = [df, state_pop, state_area, df_agg]
-    df_merged = reduce(lambda left, right: pd.merge(left,right,on=['state'],
-                                                how='inner'), data_frames)
-
-    df_merged['CFR'] = df_merged['deaths'] / df_merged['cases']
-    df_merged['IR'] = df_merged['cases'] / df_merged['total']
-    df_merged['PD'] = df_merged['total'] / df_merged['area']
-    df_merged['WMP'] = df_merged['wear_mask_prob']
-    df_ana = df_merged.loc[:, ['state', 'CFR', 'IR', 'PD', 'WMP']]
-    df_ana[['CFR', 'IR', 'PD', 'WMP']] = np.round(df_ana[['CFR', 'IR', 'PD', 'WMP']], 3)
+    df_ana = analysis.state_analytics(refresher.dataset)
 
     fig = go.Figure(data=go.Splom(
                 dimensions=[dict(label='CFR', # 'Fatality rate',
@@ -398,38 +367,7 @@ def scatter_matrix():
 
 
 def correlation_matrix():
-    df = df_dict['covid-us-state']
-    df.fips = df.fips.apply(lambda x: str(x).zfill(2))
-    df = df[df.date == max(df.date)]
-    df = df.drop(columns='date', axis=1).reset_index(drop=True)
-    state_pop = df_dict['state-population']
-    state_area =  df_dict['state-area']
-
-    mask_use = df_dict['mask-use-by-county']
-    mask_use.countyfp = mask_use.countyfp.apply(lambda x: str(x).zfill(5))
-    mask_use['wear_mask_prob'] = 0.25 * mask_use['rarely'] + 0.5 * mask_use['sometimes'] + \
-                    0.75 * mask_use['frequently'] + 1.0 * mask_use['always']
-    mask_use['state_code'] = mask_use.apply(lambda x: fip_to_state(x.countyfp), axis=1)
-    mask_use['county'] = mask_use.apply(lambda x: fip_to_county(x.countyfp), axis=1)
-    df_agg = mask_use.groupby('state_code').agg(['mean'])
-    df_agg.columns = ["_".join(x) for x in np.ravel(df_agg.columns)]
-    df_agg.reset_index(inplace=True)
-    df_agg.rename(columns={'wear_mask_prob_mean' : 'wear_mask_prob'}, inplace=True)
-    df_agg = df_agg[['state_code', 'wear_mask_prob']]
-    df_agg.drop(df_agg[df_agg['state_code'] == 'N/A'].index, inplace = True)
-    df_agg.drop(df_agg[df_agg['state_code'] == 'DC'].index, inplace = True)
-    df_agg['state'] = df_agg['state_code'].apply(lambda x: state_map_dict[x])
-    df_agg = df_agg[['state', 'wear_mask_prob']]
-    data_frames = [df, state_pop, state_area, df_agg]
-    df_merged = reduce(lambda left, right: pd.merge(left,right,on=['state'],
-                                                how='inner'), data_frames)
-
-    df_merged['CFR'] = df_merged['deaths'] / df_merged['cases']
-    df_merged['IR'] = df_merged['cases'] / df_merged['total']
-    df_merged['PD'] = df_merged['total'] / df_merged['area']
-    df_merged['WMP'] = df_merged['wear_mask_prob']
-    df_ana = df_merged.loc[:, ['state', 'CFR', 'IR', 'PD', 'WMP']]
-    df_ana[['CFR', 'IR', 'PD', 'WMP']] = np.round(df_ana[['CFR', 'IR', 'PD', 'WMP']], 3)
+    df_ana = analysis.state_analytics(refresher.dataset)
     df_corr = df_ana[['CFR', 'IR', 'PD', 'WMP']].corr()
 
     fig = go.Figure(data=go.Heatmap(z=df_corr,
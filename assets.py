@@ -0,0 +1,90 @@
+"""
+Static assets of the app: the county FIPS table and the county GeoJSON.
+They are read from the copies bundled under `data/` rather than the network, on first use, and
+kept for the life of the process. The parsed form is also cached under `CACHE_DIR` (pickle or
+marshal, per interpreter version) so later processes skip the CSV and JSON parsers. Set
+COVID_ASSETS=remote to fetch them from their original URLs instead.
+"""
+import os
+import gc
+import sys
+import json
+import pickle
+import marshal
+import functools
+from urllib.request import urlopen
+import pandas as pd
+
+ASSET_DIR = 'data'
+CACHE_DIR = os.path.join(ASSET_DIR, '.cache')
+ASSET_SOURCE = os.environ.get('COVID_ASSETS', 'bundled')     # 'bundled' or 'remote'
+FIPS_CODE_URL = 'https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/fips_code.csv'
+COUNTY_GEOJSON_URL = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
+
+
+class _gc_paused:
+    """Pauses the cyclic garbage collector, which would rescan the large object graphs built by
+    the parsers over and over while they grow
+    """
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            gc.enable()
+
+
+def _cached(source, module, parse):
+    """Returns `parse(source)`, loaded from its `module` (pickle or marshal) dump under `CACHE_DIR`
+    while that is newer than `source`, else parsed and dumped for the next process
+    """
+    cache = os.path.join(CACHE_DIR, f"{os.path.basename(source)}.{sys.implementation.cache_tag}."
+                                    f"{module.__name__}")
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(source):
+            with open(cache, 'rb') as f:
+                data = f.read()             # `marshal.load` on a file object is far slower
+            with _gc_paused():
+                return module.loads(data)
+    except Exception:
+        pass                # missing, stale or unreadable dump: parse the source again
+    with _gc_paused():
+        value = parse(source)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{cache}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(module.dumps(value))
+        os.replace(tmp, cache)
+    except OSError:
+        pass                # read-only checkout, parse again next time
+    return value
+
+
+def _read_fips_code(path):
+    return pd.read_csv(path, dtype={'fips': str})
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def fips_code():
+    """Returns the county FIPS table: 'fips' (5-digit string), 'county' and 'state' (code)
+    """
+    if ASSET_SOURCE == 'remote':
+        return _read_fips_code(FIPS_CODE_URL)
+    return _cached(os.path.join(ASSET_DIR, 'fips_code.csv'), pickle, _read_fips_code)
+
+
+@functools.lru_cache(maxsize=None)
+def county_geojson():
+    """Returns the GeoJSON of the US counties, features identified by their FIPS code
+    """
+    if ASSET_SOURCE == 'remote':
+        with urlopen(COUNTY_GEOJSON_URL) as response:
+            return json.load(response)
+    return _cached(os.path.join(ASSET_DIR, 'geojson-counties-fips.json'), marshal, _read_json)
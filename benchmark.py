@@ -0,0 +1,393 @@
+"""
+Benchmarks for the ingestion path. Requires a local mongod (see docker.txt); every write goes
+to the scratch database `BENCH_DB`, never to 'covid-us'.
+
+    python benchmark.py upsert --rows 50000 --batch-size 1000
+    python benchmark.py ingest            # replays the on-disk mirror, no network
+    python benchmark.py parse --rows 500000
+    python benchmark.py read              # Mongo vs columnar snapshots, reads 'covid-us'
+    python benchmark.py storage --rows 50000     # Mongo vs SQLite through `storage`
+    python benchmark.py decode --rows 16500      # dict vs raw BSON decoding at 1x, 10x, 100x
+    python benchmark.py analytics         # pandas vs aggregation pipelines, reads 'covid-us'
+    python benchmark.py startup --cold    # `import app` to its first layout response
+    python benchmark.py lookup            # row-wise FIPS scans vs `lookup.map_fips`, no mongod
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pymongo
+import bson
+
+import data_acquire
+import sources
+import storage
+
+BENCH_DB = 'covid-us-bench'
+
+
+def synthetic_state_df(rows):
+    """Returns a `DataFrame` shaped like the 'covid-us-state' level with roughly `rows` rows
+    """
+    n_days = max(1, rows // len(data_acquire.all_states))
+    dates = pd.date_range('2020-01-21', periods=n_days, freq='D')
+    df = pd.DataFrame({
+        'date': np.repeat(dates, len(data_acquire.all_states)),
+        'state': np.tile(data_acquire.all_states, n_days),
+    })
+    df['fips'] = np.tile(np.arange(len(data_acquire.all_states)), n_days)
+    df['cases'] = np.arange(len(df))
+    df['deaths'] = np.arange(len(df)) // 50
+    return df
+
+
+MASK_USE_ANSWERS = ['NEVER', 'RARELY', 'SOMETIMES', 'FREQUENTLY', 'ALWAYS']
+
+
+def synthetic_mask_use_df(rows, seed=0):
+    """Returns a `DataFrame` shaped like the stored 'mask-use-by-county' level with `rows` rows
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'COUNTYFP': [f"{fips:05d}" for fips in rng.integers(1000, 99999, rows)]})
+    for answer in MASK_USE_ANSWERS:
+        df[answer] = rng.random(rows)
+    return df
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    ret = fn(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+
+def _report(name, phase, rows, seconds):
+    print(f"{name:>12} {phase:>7}: {rows} rows in {seconds:.2f}s, {rows / seconds:,.0f} rows/sec")
+
+
+def legacy_upsert(collection, records, level):
+    """The pre-bulk_write path: one `replace_one` round trip per record"""
+    for record in records:
+        filter_ = {_:record[_] for _ in sources.filters[level]}
+        collection.replace_one(filter=filter_, replacement=record, upsert=True)
+
+
+def bench_upsert(rows=50000, batch_size=data_acquire.UPSERT_BATCH_SIZE,
+                 ordered=data_acquire.UPSERT_ORDERED):
+    """Compares per-row `replace_one` against batched `bulk_write`, both on an empty collection
+    (all inserts) and on a populated one (all updates). The filter keys are indexed in the scratch
+    collection so both paths pay for round trips rather than collection scans.
+    """
+    level = 'covid-us-state'
+    collection = pymongo.MongoClient().get_database(BENCH_DB).get_collection(level)
+    records = synthetic_state_df(rows).to_dict('records')
+    candidates = [
+        ('replace_one', lambda: legacy_upsert(collection, records, level)),
+        ('bulk_write', lambda: storage.bulk_upsert(collection, records, level,
+                                                        batch_size=batch_size, ordered=ordered)),
+    ]
+    for name, fn in candidates:
+        collection.drop()
+        collection.create_index([(_, pymongo.ASCENDING) for _ in sources.filters[level]])
+        seconds, _ = _timed(fn)
+        _report(name, 'insert', len(records), seconds)
+        seconds, _ = _timed(fn)
+        _report(name, 'update', len(records), seconds)
+    collection.drop()
+
+
+def bench_ingest(repeat=3, incremental=False, backend=None):
+    """Times full `update_once` cycles replayed from the on-disk mirror (or the bundled `data/`
+    CSVs) into a freshly dropped `BENCH_DB`, so results depend on nothing but the local machine.
+    """
+    if backend:
+        storage.STORAGE_BACKEND = backend
+        os.environ['COVID_STORAGE'] = backend   # for any process started from here
+    store = storage.get_storage(BENCH_DB)
+    data_acquire.DB_NAME = BENCH_DB
+    for i in range(repeat):
+        store.drop()
+        seconds, _ = _timed(data_acquire.update_once, incremental=incremental, replay=True)
+        print(f"ingest cycle {i}: {seconds:.2f}s")
+    store.drop()
+
+
+def bench_parse(rows=500000, level='covid-us-state'):
+    """Compares `filter_db` with inferred dtypes against the typed `sources.schemas` path on a
+    synthetic CSV of `rows` rows: parse time and deep memory of the resulting frame
+    """
+    df = synthetic_state_df(rows)
+    df['fips'] = df['fips'].map(lambda x: str(x).zfill(2))
+    text = df.to_csv(index=False, date_format='%Y-%m-%d')
+    for name, typed_level in (('inferred', None), ('typed', level)):
+        seconds, frame = _timed(data_acquire.filter_db, text, typed_level)
+        memory = frame.memory_usage(deep=True).sum() / 2**20
+        print(f"{name:>12}: {len(frame)} rows in {seconds:.2f}s, {memory:.1f} MiB")
+
+
+def bench_storage(rows=50000, backends=('mongo', 'sqlite')):
+    """Runs the same workload through every `storage` backend on a synthetic 'covid-us-state'
+    level: upsert into an empty table (inserts), upsert again (updates), one state's date range,
+    and a whole-level fetch
+    """
+    level = 'covid-us-state'
+    df = synthetic_state_df(rows)
+    df['fips'] = df['fips'].map(lambda x: str(x).zfill(2))
+    records = df.to_dict('records')
+    for record in records:
+        record['date'] = record['date'].to_pydatetime()
+    start, end = records[len(records) // 4]['date'], records[3 * len(records) // 4]['date']
+    for backend in backends:
+        store = storage.get_storage(BENCH_DB, backend)
+        store.drop()
+        store.ensure_indexes()
+        seconds, _ = _timed(store.upsert_batch, level, records)
+        _report(backend, 'insert', len(records), seconds)
+        seconds, _ = _timed(store.upsert_batch, level, records)
+        _report(backend, 'update', len(records), seconds)
+        seconds, found = _timed(store.query_range, level, start, end, where={'state': 'Texas'},
+                                columns=['date', 'cases', 'deaths'])
+        print(f"{backend:>12}   range: {len(found)} rows in {seconds * 1000:.1f}ms")
+        seconds, found = _timed(store.fetch_level, level)
+        _report(backend, 'fetch', len(found), seconds)
+        store.drop()
+
+
+def _bson_batches(df, batch_size):
+    documents = [bson.encode(record) for record in df.to_dict('records')]
+    return [b''.join(documents[i:i + batch_size]) for i in range(0, len(documents), batch_size)]
+
+
+def _decoded_documents(batches):
+    import columnar
+
+    return columnar.frame_from_documents([d for batch in batches for d in bson.decode_all(batch)])
+
+
+def bench_decode(rows=16500, scales=(1, 10, 100), batch_size=storage.QUERY_BATCH_SIZE, trials=1000):
+    """Compares building the 'covid-us-state' and 'mask-use-by-county' frames from decoded
+    documents (`decode_all` + `from_records`, what a regular cursor does) against
+    `database.decode_raw_batches`, on BSON batches of `batch_size` synthetic documents at every
+    scale of `rows` (~the current state count). Then checks both agree on `trials` small random
+    batches of each layout, where field bytes are most likely to look like document headers.
+    """
+    import database
+
+    layouts = {
+        'covid-us-state': lambda n, seed: synthetic_state_df(n).assign(
+            fips=lambda df: df['fips'].map(lambda x: str(x).zfill(2))),
+        'mask-use-by-county': synthetic_mask_use_df,
+    }
+    for level, make in layouts.items():
+        for scale in scales:
+            batches = _bson_batches(make(rows * scale, 0), batch_size)
+            seconds_dict, expected = _timed(_decoded_documents, batches)
+            seconds_raw, frame = _timed(database.decode_raw_batches, batches)
+            pd.testing.assert_frame_equal(frame, expected)
+            print(f"{level:>18} {scale:>4}x {len(frame):>9} rows: dicts {seconds_dict:.2f}s, "
+                  f"raw {seconds_raw:.2f}s ({seconds_dict / seconds_raw:.1f}x)")
+        rng = np.random.default_rng(1)
+        for trial in range(trials):
+            n = int(rng.integers(1, 60))
+            df = make(n, trial).sample(frac=1, random_state=trial).head(n)
+            batches = _bson_batches(df, int(rng.integers(1, n + 1)))
+            pd.testing.assert_frame_equal(database.decode_raw_batches(batches),
+                                          _decoded_documents(batches))
+        print(f"{level:>18}: raw decode equal on {trials} random batches")
+
+
+def _analytics_pandas(db):
+    """The path of `app.scatter_matrix`: whole levels into pandas, then
+    `analysis.build_state_analytics`
+    """
+    import analysis
+    import columnar
+
+    frames = {level: columnar.frame_from_documents(list(db.get_collection(level).find()))
+              for level in analysis.STATE_ANALYTICS_LEVELS}
+    return analysis.build_state_analytics(frames)
+
+
+def bench_analytics(repeat=5):
+    """Compares building the inputs of the scatter and correlation matrices in pandas from whole
+    levels against `database.aggregate_state_analytics`, which ships only the joined rows, and
+    checks both build the same rows
+    """
+    import database
+
+    db = database.store.db
+    frames = {}
+    for name, fn in (('pandas', lambda: _analytics_pandas(db)),
+                     ('aggregate', database.aggregate_state_analytics)):
+        seconds = []
+        for _ in range(repeat):
+            elapsed, frames[name] = _timed(fn)
+            seconds.append(elapsed)
+        print(f"{name:>12}: {len(frames[name])} rows, best {min(seconds) * 1000:.1f}ms "
+              f"of {repeat}, median {sorted(seconds)[repeat // 2] * 1000:.1f}ms")
+    columns = ['state', 'cases', 'deaths', 'total', 'area', 'wear_mask_prob']
+    pd.testing.assert_frame_equal(
+        frames['aggregate'][columns],
+        frames['pandas'][columns].sort_values('state', ignore_index=True), check_dtype=False)
+    print('aggregate equals pandas')
+
+
+_STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.server.test_client()
+status = client.get('/_dash-layout').status_code     # builds every figure of the page
+print(json.dumps({'import': imported - start, 'response': time.perf_counter() - imported,
+                  'status': status}))
+"""
+
+
+def bench_startup(repeat=3, cold=False):
+    """Times `import app` (data load included) and its first layout response, each run in a fresh
+    interpreter like a freshly booted worker. With `cold`, the parsed asset cache of `assets` is
+    removed before the first run.
+    """
+    import assets
+
+    if cold:
+        shutil.rmtree(assets.CACHE_DIR, ignore_errors=True)
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _STARTUP_PROBE], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"startup {i}: import {result['import']:.2f}s, first response "
+              f"{result['response']:.2f}s (HTTP {result['status']}), "
+              f"total {result['import'] + result['response']:.2f}s")
+
+
+def _scan_fips(fips_code, fip, column):
+    values = fips_code.loc[fips_code.fips == fip, column].to_numpy()
+    return 'N/A' if len(values) == 0 else values[0]
+
+
+def bench_lookup(repeat=3):
+    """Maps the county FIPS codes of the mask-use level (every code of the bundled table) to
+    their county and state code, row by row through the former table scans vs one
+    `lookup.map_fips` call, and checks both agree
+    """
+    import assets
+    import lookup
+
+    fips_code = assets.fips_code()
+    df = pd.DataFrame({'countyfp': fips_code['fips'].to_numpy()})
+    lookup.map_fips(df['countyfp'].head(1))         # build the tables outside the timings
+    for i in range(repeat):
+        seconds, scanned = _timed(lambda: pd.DataFrame({
+            'state_code': df.apply(lambda x: _scan_fips(fips_code, x.countyfp, 'state'), axis=1),
+            'county': df.apply(lambda x: _scan_fips(fips_code, x.countyfp, 'county'), axis=1)}))
+        _report('scan', str(i), len(df), seconds)
+        seconds, mapped = _timed(lookup.map_fips, df['countyfp'])
+        _report('map_fips', str(i), len(df), seconds)
+        assert scanned.equals(mapped[['state_code', 'county']].astype(scanned.dtypes))
+
+
+def _rss_mib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def _load_all(backend, results):
+    """Loads every app level through `backend` in a fresh process, reports time and memory"""
+    # imported by both backends so it is part of the baseline
+    import pyarrow  # noqa: F401
+    import database
+    import columnar
+
+    baseline = _rss_mib()
+    start = time.perf_counter()
+    if backend == 'columnar':
+        df_dict = database.fetch_all_columnar()
+    else:
+        df_dict = {level: columnar.frame_from_documents(database.store.fetch_level(level))
+                   for level in database.levels}
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - baseline
+    rows = sum(len(df) for df in df_dict.values()) if df_dict else 0
+    results.put((seconds, rows, peak))
+
+
+def bench_read():
+    """Compares loading every app level from the store (`fetch_level` + `from_records`, one level
+    after the other) against the memory-mapped columnar snapshots, each in its own
+    process so peak RSS growth is measured separately
+    """
+    ctx = multiprocessing.get_context('spawn')
+    for backend in ('mongo', 'columnar'):
+        results = ctx.Queue()
+        p = ctx.Process(target=_load_all, args=(backend, results))
+        p.start()
+        seconds, rows, peak = results.get()
+        p.join()
+        print(f"{backend:>12}: {rows} rows in {seconds:.2f}s, peak RSS +{peak:.1f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('upsert', help='per-row replace_one vs batched bulk_write')
+    p.add_argument('--rows', type=int, default=50000)
+    p.add_argument('--batch-size', type=int, default=data_acquire.UPSERT_BATCH_SIZE)
+    p.add_argument('--ordered', action='store_true')
+
+    p = sub.add_parser('ingest', help='full update_once cycles replayed from the mirror')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--incremental', action='store_true')
+    p.add_argument('--backend', choices=['mongo', 'sqlite'], default=None)
+
+    p = sub.add_parser('parse', help='inferred vs schema-typed filter_db')
+    p.add_argument('--rows', type=int, default=500000)
+
+    sub.add_parser('read', help='Mongo vs columnar snapshot load of every app level')
+
+    p = sub.add_parser('analytics', help='pandas vs aggregation pipeline analytics inputs')
+    p.add_argument('--repeat', type=int, default=5)
+
+    p = sub.add_parser('startup', help='import-to-first-response time of app.py')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--cold', action='store_true')
+
+    p = sub.add_parser('decode', help='dict vs raw BSON decoding of the state and mask use levels')
+    p.add_argument('--rows', type=int, default=16500)
+    p.add_argument('--trials', type=int, default=1000)
+
+    p = sub.add_parser('storage', help='Mongo vs SQLite storage backends')
+    p.add_argument('--rows', type=int, default=50000)
+    p.add_argument('--backend', action='append', choices=['mongo', 'sqlite'])
+
+    p = sub.add_parser('lookup', help='row-wise FIPS scans vs vectorized lookup')
+    p.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.bench == 'upsert':
+        bench_upsert(args.rows, args.batch_size, args.ordered)
+    elif args.bench == 'ingest':
+        bench_ingest(args.repeat, args.incremental, args.backend)
+    elif args.bench == 'parse':
+        bench_parse(args.rows)
+    elif args.bench == 'read':
+        bench_read()
+    elif args.bench == 'storage':
+        bench_storage(args.rows, args.backend or ('mongo', 'sqlite'))
+    elif args.bench == 'decode':
+        bench_decode(args.rows, trials=args.trials)
+    elif args.bench == 'analytics':
+        bench_analytics(args.repeat)
+    elif args.bench == 'startup':
+        bench_startup(args.repeat, args.cold)
+    elif args.bench == 'lookup':
+        bench_lookup(args.repeat)
@@ -0,0 +1,79 @@
+"""
+Columnar snapshots of the 'covid-us' levels, an alternative read backend to Mongo.
+After each successful ingest `data_acquire` writes every level as an uncompressed Arrow IPC file
+(or Parquet), holding the same frame `database.fetch_all_db_as_df` builds. `read` memory-maps it
+and only materializes the requested columns. Snapshots of each database live in their own
+directory, so scratch databases never replace those of 'covid-us'. Requires pyarrow.
+"""
+import os
+import functools
+import importlib.util
+import pandas as pd
+
+SNAPSHOT_DIR = 'snapshots'       # one subdirectory per database
+DB_NAME = 'covid-us'             # database of the snapshots served to the app
+FORMAT = 'arrow'                 # 'arrow' (IPC file, memory-mapped) or 'parquet'
+_SUFFIX = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+
+def path(level, fmt=FORMAT, db_name=DB_NAME):
+    return os.path.join(SNAPSHOT_DIR, db_name, level + _SUFFIX[fmt])
+
+
+def exists(level, fmt=FORMAT, db_name=DB_NAME):
+    return os.path.isfile(path(level, fmt, db_name))
+
+
+@functools.lru_cache(maxsize=None)
+def available():
+    """Returns whether pyarrow is installed, checked once per process"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def frame_from_documents(documents):
+    """Returns the `DataFrame` of Mongo `documents` with '_id' removed and lower-case columns,
+    as served by `database.fetch_all_db_as_df`
+    """
+    df = pd.DataFrame.from_records(documents)
+    df.drop('_id', axis=1, inplace=True, errors='ignore')
+    df.columns = map(str.lower, df.columns)
+    return df
+
+
+def write(level, df, fmt=FORMAT, db_name=DB_NAME):
+    """Atomically replaces the snapshot of `level` of `db_name` with `df`, returns its path
+    """
+    import pyarrow as pa
+
+    target = path(level, fmt, db_name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + '.tmp'
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmp)
+    else:
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:   # uncompressed: zero-copy mmap
+                writer.write_table(table)
+    os.replace(tmp, target)
+    return target
+
+
+def read(level, columns=None, fmt=FORMAT, db_name=DB_NAME):
+    """Returns the snapshot of `level` of `db_name` as a `DataFrame`, only `columns` if given.
+    Returns None if there is no snapshot.
+    """
+    import pyarrow as pa
+
+    if not exists(level, fmt, db_name):
+        return None
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(path(level, fmt, db_name), columns=columns,
+                             memory_map=True).to_pandas()
+    with pa.memory_map(path(level, fmt, db_name), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
@@ -2,37 +2,32 @@
 Coronavirus (Covid-19) Data in the United States
 """
 import time
-import sched
+import datetime
+import argparse
+import hashlib
+import queue
+import atexit
+import threading
+import multiprocessing
 import pandas as pd
 import logging
 import requests
 from io import StringIO
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
-import pymongo
 
 import utils
-
-urls = {
-    'covid-us': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us.csv",
-    'covid-us-state': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv",
-#     'covid-us-county': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv", # too large, skipped!
-    'mask-use-by-county': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/mask-use/mask-use-by-county.csv",
-    'state-population': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/PopulationState.csv",
-    'county-population': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/PopulationCounty.csv",
-    'fips_code': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/fips_code.csv",
-    'state-area': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/StateArea.csv",
-}
-
-filters = {
-    'covid-us': ['date'],
-    'covid-us-state': ['date', 'state'],
-#     'covid-us-county': ['date', 'county'],
-    'mask-use-by-county': ['COUNTYFP'],
-    'state-population': ['state'],
-    'county-population': ['county'],
-    'fips_code': ['county'],
-    'state-area': ['state'],
-}
+import mirror
+import metrics
+import scheduler
+import derived
+import columnar
+import storage
+from storage import UPSERT_BATCH_SIZE, UPSERT_ORDERED, UPSERT_MODE
+from sources import urls, schemas, SCHEMA_VERSION, DATE_FORMAT
 
 all_states = np.array(['Washington', 'Wisconsin', 'Wyoming', 'Illinois', 'California',
        'Arizona', 'Massachusetts', 'Texas', 'Nebraska', 'Utah', 'Oregon',
@@ -50,96 +45,552 @@ all_states = np.array(['Washington', 'Wisconsin', 'Wyoming', 'Illinois', 'Califo
 
 
 # MAX_DOWNLOAD_ATTEMPT = 5
+DB_NAME = 'covid-us'
 DOWNLOAD_PERIOD = 3600*24        # second, one day update
+UPDATE_PERIODS = {               # second, per level; levels not listed use `DOWNLOAD_PERIOD`
+    'covid-us': 3600*6,
+    'covid-us-state': 3600*6,
+    'covid-us-county': 3600*12,
+    'mask-use-by-county': 3600*24*7,
+    'state-population': 3600*24*7,
+    'county-population': 3600*24*7,
+    'fips_code': 3600*24*7,
+    'state-area': 3600*24*7,
+}
+INCREMENTAL = True               # only upsert rows at or after the stored watermark
+REVISION_WINDOW_DAYS = 3         # days before the watermark re-upserted for NYT back-corrections
+NOT_MODIFIED = 'not-modified'    # returned by `download_db` on HTTP 304
+SKIP_UNCHANGED = True            # skip parse and upsert when the payload hash matches the last run
+STREAMED_LEVELS = {'covid-us-county'}   # parsed and upserted chunk by chunk, see `stream_db`
+STREAM_CHUNK_ROWS = 50000        # rows per `read_csv` chunk, bounds peak memory of `stream_db`
+DOWNLOAD_WORKERS = 4             # concurrent downloads in `update_once`
+DOWNLOAD_TIMEOUT = (3.05, 30)    # seconds, (connect, read)
+DOWNLOAD_RETRIES = 3             # retries per download on connection errors and 429/5xx
+DOWNLOAD_BACKOFF = 0.5           # seconds, exponential backoff factor between retries
+PIPELINE_QUEUE_SIZE = 2          # frames buffered between download, parse and upsert stages
+MIRROR_ENABLED = True            # keep a compressed copy of every download, see `mirror`
+REPLAY = False                   # ingest from the mirror (or bundled `data/`) instead of the network
+METRICS_JSON = 'metrics.json'    # JSON dump of `metrics` written after every cycle
+COLUMNAR_SNAPSHOTS = True        # write an Arrow/Parquet snapshot of each level after ingest
+PARTITIONED_LEVELS = {'covid-us-county'}    # upserted in parallel partitions, see `partitioned_upsert`
+PARTITION_BY = 'state'           # 'state' -> one partition per state, 'fips' -> per state FIPS prefix
+PARTITION_WORKERS = 4            # worker processes for partitioned upserts, <= 1 writes inline
 
-client = pymongo.MongoClient()
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'data.log')
 
 
-def download_db(url=urls['covid-us']):
+def _make_session():
+    """Returns a `requests.Session` with a connection pool sized for `DOWNLOAD_WORKERS` that
+    retries idempotent requests with exponential backoff
+    """
+    retry = Retry(total=DOWNLOAD_RETRIES, backoff_factor=DOWNLOAD_BACKOFF,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']))
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS,
+                          max_retries=retry)
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+session = _make_session()
+
+
+def _store():
+    """Returns the storage of `DB_NAME` on the configured backend, see `storage`"""
+    return storage.get_storage(DB_NAME)
+
+
+def load_meta(level):
+    """Returns the persisted ingestion state of `level`, an empty dict if there is none
+    """
+    return _store().get_meta(level)
+
+
+def save_meta(level, **fields):
+    """Merges `fields` into the persisted ingestion state of `level`
+    """
+    _store().set_meta(level, **fields)
+
+
+def _conditional_headers(validators):
+    """Returns the If-None-Match/If-Modified-Since headers built from `validators`
+    """
+    headers = {}
+    if validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _remember_validators(req, validators):
+    if validators is not None:
+        validators['etag'] = req.headers.get('ETag')
+        validators['last_modified'] = req.headers.get('Last-Modified')
+
+
+def download_db(url=urls['covid-us'], validators=None):
     """Returns US-national Covid-19 data from `NYTIMES_SOURCE` that includes total cases and deaths
     Returns None if network failed
+    When `validators` (a dict with 'etag'/'last_modified') is given, the request is conditional:
+    `NOT_MODIFIED` is returned on HTTP 304, otherwise `validators` is updated in place with the
+    validators of the fresh response.
     """
     text = None
     try:
-        req = requests.get(url, timeout=0.5)
+        req = session.get(url, timeout=DOWNLOAD_TIMEOUT, headers=_conditional_headers(validators))
+        if req.status_code == requests.codes.not_modified:
+            return NOT_MODIFIED
         req.raise_for_status()
         text = req.text
-    except requests.exceptions.HTTPError as e:
-        logger.warning("Retry on HTTP Error: {}".format(e))
+    except requests.exceptions.RequestException as e:
+        logger.warning("Download failed after retries: {}".format(e))
         return None
+    _remember_validators(req, validators)
     if text is None:
         logger.error('download covid19-us too many FAILED attempts')
+    elif MIRROR_ENABLED:
+        mirror.save(url, text)
     return text
 
 
-def filter_db(text):
-    """Converts `text` to `DataFrame`, removes empty lines and descriptions
+_read_dtypes = {'fips2': str, 'fips5': str, 'str': str}
+
+
+def read_dtypes(level):
+    """Returns the `read_csv` dtypes of the `schemas` entry of `level` (empty if it has none).
+    Dates are parsed and int32 counts narrowed by `_clean` once empty rows are dropped, since
+    nullable integer parsing in `read_csv` is several times slower than the inferred int64/float64.
+    """
+    return {col: _read_dtypes.get(t, t) for col, t in schemas.get(level, {}).items()
+            if t not in ('date', 'int32')}
+
+
+def _clean(df, level=None):
+    """Strips column names, parses dates and drops rows with empty cells, then narrows the
+    columns of `level` to their `schemas` types
     """
-    # use StringIO to convert string to a readable buffer
-    df = pd.read_csv(StringIO(text), delimiter=',')
     df.columns = df.columns.str.strip()             # remove space in columns name
+    schema = schemas.get(level, {})
     if 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
+        df['date'] = pd.to_datetime(df['date'], format=DATE_FORMAT if schema else None)
     df.dropna(inplace=True)             # drop rows with empty cells
+    for col, t in schema.items():
+        if col not in df.columns or t == 'date':
+            continue
+        if t == 'int32':
+            df[col] = df[col].astype('int32')
+        elif t.startswith('fips'):
+            width = int(t[len('fips'):])
+            if (df[col].str.len() < width).any():      # NYT files are usually padded already
+                df[col] = df[col].str.zfill(width)
     return df
 
 
-def upsert_db(df, level='covid-us'):
-    """
-    Update MongoDB database 'covid-us' and collections with the given `DataFrame`.
-    """
-    db = client.get_database("covid-us")
-    collection = db.get_collection(level)
-    update_count = 0
-    if level == 'covid-us-county':
-        for state in all_states:
-            df_state = df[df['state'] == state]
-        for record in df_state.to_dict('records'):
-            filter_ = {_:record[_] for _ in filters[level]}
-            result = collection.replace_one(
-                filter=filter_,                             # locate the document if exists
-                replacement=record,                         # latest document
-                upsert=True)                                # update if exists, insert if not
-            if result.matched_count > 0:
-                update_count += 1
+def filter_db(text, level=None):
+    """Converts `text` to `DataFrame`, removes empty lines and descriptions
+    Columns are typed after `schemas[level]` when `level` is given, inferred otherwise.
+    """
+    # use StringIO to convert string to a readable buffer
+    df = pd.read_csv(StringIO(text), delimiter=',', dtype=read_dtypes(level))
+    return _clean(df, level)
+
+
+def migrate_schema(level):
+    """Drops the documents of `level` whose FIPS columns were stored as numbers by a previous
+    `SCHEMA_VERSION`; they are reloaded as zero-padded strings by the next full ingest
+    """
+    for col, t in schemas.get(level, {}).items():
+        if t.startswith('fips'):
+            deleted = _store().delete_numeric(level, col)
+            logger.info(f"{level}: dropped {deleted} documents with numeric {col}")
+
+
+def _stream_chunks(source, level, watermark, chunksize):
+    max_date = None
+    for chunk in pd.read_csv(source, delimiter=',', chunksize=chunksize, dtype=read_dtypes(level)):
+        chunk = _clean(chunk, level)
+        if 'date' in chunk.columns and len(chunk):
+            chunk_max = chunk['date'].max()
+            max_date = chunk_max if max_date is None else max(max_date, chunk_max)
+        chunk = incremental_rows(chunk, watermark)
+        if len(chunk):
+            upsert_db(chunk, level)
+    return max_date
+
+
+def stream_db(url, level, validators=None, watermark=None, chunksize=STREAM_CHUNK_ROWS,
+              replay=False):
+    """Streams the CSV at `url` into `level` without holding the whole file in memory.
+    The HTTP body is read incrementally and parsed by `read_csv` in chunks of `chunksize` rows;
+    every chunk is cleaned, trimmed to `watermark` and upserted before the next one is read.
+    With `replay`, the latest mirrored copy of `url` is streamed instead of the network.
+    Returns the max date seen (None if no date column), `NOT_MODIFIED` on HTTP 304, or None
+    if network failed.
+    """
+    if replay:
+        source = mirror.open_latest(url)
+        if source is None:
+            logger.warning(f"{level}: nothing mirrored for {url}")
+            return None
+        with source:
+            return _stream_chunks(source, level, watermark, chunksize)
+    try:
+        req = session.get(url, timeout=DOWNLOAD_TIMEOUT, headers=_conditional_headers(validators),
+                          stream=True)
+        if req.status_code == requests.codes.not_modified:
+            return NOT_MODIFIED
+        req.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning("Download failed after retries: {}".format(e))
+        return None
+    _remember_validators(req, validators)
+    with req:
+        req.raw.decode_content = True                # transparently gunzip the raw stream
+        if not MIRROR_ENABLED:
+            return _stream_chunks(req.raw, level, watermark, chunksize)
+        with mirror.snapshot(url) as sink:
+            return _stream_chunks(mirror.Tee(req.raw, sink), level, watermark, chunksize)
+
+
+_partition_pool = None
+
+
+def _get_partition_pool(workers):
+    """Returns the lazily started pool of `workers` processes, each opening its own storage.
+    Processes are spawned rather than forked since the parent already runs pymongo threads.
+    """
+    global _partition_pool
+    if _partition_pool is None:
+        _partition_pool = ProcessPoolExecutor(max_workers=workers,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(_partition_pool.shutdown)
+    return _partition_pool
+
+
+def _upsert_partition(key, df, level, db_name, backend, batch_size, ordered, mode):
+    """Upserts one partition from a worker process, returns its stats for `partitioned_upsert`.
+    `backend` is that of the parent, which workers may not see in their environment.
+    """
+    start = time.perf_counter()
+    updated, inserted = storage.get_storage(db_name, backend).upsert_batch(
+        level, df.to_dict('records'), batch_size=batch_size, ordered=ordered, mode=mode)
+    return key, df.shape[0], updated, inserted, time.perf_counter() - start
+
+
+def partition_keys(df, by=PARTITION_BY):
+    """Returns the partition key of every row of `df`: its state, or the 2-digit state prefix
+    of its county FIPS code
+    """
+    if by == 'fips':
+        return df['fips'].str[:2]
+    return df['state']
+
+
+def partitioned_upsert(df, level, workers=PARTITION_WORKERS, by=PARTITION_BY,
+                       batch_size=UPSERT_BATCH_SIZE, ordered=UPSERT_ORDERED, mode=UPSERT_MODE):
+    """Splits `df` by `partition_keys` and upserts the partitions in parallel over `workers`
+    processes. Logs rows and latency of every partition, returns `(update_count, insert_count)`.
+    """
+    partitions = df.groupby(partition_keys(df, by), observed=True)
+    args = (level, DB_NAME, storage.STORAGE_BACKEND, batch_size, ordered, mode)
+    if workers <= 1:
+        results = [_upsert_partition(key, part, *args) for key, part in partitions]
+    else:
+        pool = _get_partition_pool(workers)
+        futures = [pool.submit(_upsert_partition, key, part, *args) for key, part in partitions]
+        results = [future.result() for future in as_completed(futures)]
+    update_count, insert_count = 0, 0
+    for key, rows, updated, inserted, seconds in results:
+        logger.info(f"{level}[{key}]: rows={rows}, update={updated}, insert={inserted}, "
+                    f"latency={seconds:.2f}s")
+        update_count += updated
+        insert_count += inserted
+    return update_count, insert_count
+
+
+def upsert_db(df, level='covid-us', batch_size=UPSERT_BATCH_SIZE, ordered=UPSERT_ORDERED,
+              mode=UPSERT_MODE):
+    """
+    Update the 'covid-us' storage (MongoDB by default) with the given `DataFrame`.
+    Rows are written as batched upserts, see `storage.bulk_upsert`; levels in
+    `PARTITIONED_LEVELS` are split and written in parallel, see `partitioned_upsert`.
+    Returns `(update_count, insert_count)`.
+    """
+    start = time.perf_counter()
+    if level in PARTITIONED_LEVELS:
+        update_count, insert_count = partitioned_upsert(df, level, batch_size=batch_size,
+                                                        ordered=ordered, mode=mode)
     else:
-        for record in df.to_dict('records'):
-            filter_ = {_:record[_] for _ in filters[level]}
-            result = collection.replace_one(
-                filter=filter_,                             # locate the document if exists
-                replacement=record,                         # latest document
-                upsert=True)                                # update if exists, insert if not
-            if result.matched_count > 0:
-                update_count += 1
+        update_count, insert_count = _store().upsert_batch(level, df.to_dict('records'),
+                                                           batch_size=batch_size, ordered=ordered,
+                                                           mode=mode)
     logger.info(f"{level.split('-')[-1]}:"
           f"rows={df.shape[0]}, update={update_count}, "
-          f"insert={df.shape[0]-update_count}")
+          f"insert={insert_count}")
+    metrics.inc('upsert_seconds_total', time.perf_counter() - start, level)
+    metrics.inc('upsert_matched_total', update_count, level)
+    metrics.inc('upsert_inserted_total', insert_count, level)
+    return update_count, insert_count
+
+
+def refresh_derived(level, df):
+    """Recomputes the derived series touched by upserting `df` into `level`: the dates of `df`
+    for the national and state levels, everything when the state population changed
+    """
+    if level == 'state-population':
+        todo = [(source, None) for source in derived.targets]
+    elif level in derived.targets and len(df):
+        todo = [(level, df['date'].min().to_pydatetime())]
+    else:
+        return
+    store = _store()
+    for source, since in todo:
+        start = time.perf_counter()
+        df_derived = derived.load(store, source, since)
+        if df_derived.empty:
+            continue
+        target = derived.targets[source]
+        update_count, insert_count = store.upsert_batch(target, df_derived.to_dict('records'))
+        store.bump_version(target)
+        logger.info(f"{target}: rows={df_derived.shape[0]}, update={update_count}, "
+                    f"insert={insert_count}, derive={time.perf_counter() - start:.2f}s")
+
+
+def write_snapshot(level):
+    """Writes the whole stored `level` as a columnar snapshot, see `columnar`. Streamed levels
+    are skipped since they are never read whole.
+    """
+    if not COLUMNAR_SNAPSHOTS or level in STREAMED_LEVELS:
+        return
+    if not columnar.available():
+        # checked before reading the whole level, which would be wasted without pyarrow
+        logger.warning(f"{level}: columnar snapshot skipped: pyarrow is not installed")
+        return
+    start = time.perf_counter()
+    documents = _store().fetch_level(level)
+    target = columnar.write(level, columnar.frame_from_documents(documents), db_name=DB_NAME)
+    logger.info(f"{level}: snapshot={target} in {time.perf_counter() - start:.2f}s")
 
 
-def update_once():
-    for level, url in urls.items():
-        t = download_db(url)
-        df = filter_db(t)
-        upsert_db(df, level)
+def incremental_rows(df, watermark, revision_window=REVISION_WINDOW_DAYS):
+    """Returns the rows of `df` dated at or after `watermark` minus `revision_window` days.
+    Frames without a 'date' column, or levels without a watermark yet, are returned whole.
+    """
+    if watermark is None or 'date' not in df.columns:
+        return df
+    since = pd.Timestamp(watermark) - pd.Timedelta(days=revision_window)
+    return df[df['date'] >= since]
 
 
-def main_loop(timeout=DOWNLOAD_PERIOD):
-    scheduler = sched.scheduler(time.time, time.sleep)
+_DONE = object()         # end-of-stream marker passed between pipeline stages
 
-    def _worker():
+
+def payload_digest(payload):
+    """Returns the SHA-256 hex digest of the encoded bytes of a downloaded payload
+    """
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _fetch_stage(level, url, incremental, replay, parse_q):
+    """Downloads `level` (or reads its mirrored copy with `replay`) and hands the payload to the
+    parse stage. Streamed levels are parsed and upserted right here, chunk by chunk, since they
+    never exist as a single payload. Returns the outcome of the level for the cycle summary.
+    """
+    meta = load_meta(level)
+    if meta.get('schema_version') != SCHEMA_VERSION:
+        migrate_schema(level)
+        meta = {}                   # stored types changed: reload in full, ignore watermark and hash
+    validators = {'etag': meta.get('etag'), 'last_modified': meta.get('last_modified')} \
+        if incremental and not replay else None
+    state = {'schema_version': SCHEMA_VERSION}  # ingestion state persisted once rows are stored
+    start = time.perf_counter()
+    if level in STREAMED_LEVELS:
+        max_date = stream_db(url, level, validators, meta.get('watermark') if incremental else None,
+                             replay=replay)
+        seconds = time.perf_counter() - start
+        logger.info(f"{level}: stream={seconds:.2f}s")
+        metrics.set_gauge('download_seconds', seconds, level)
+        if max_date is None or max_date is NOT_MODIFIED:
+            logger.info(f"{level}: nothing streamed")
+            if max_date is None:
+                return 'failed'
+            metrics.set_gauge('last_success_timestamp', time.time(), level)
+            return 'not-modified'
+        state['watermark'] = max_date.to_pydatetime()
+        if validators is not None:
+            state.update(validators)
+        save_meta(level, ready_at=datetime.datetime.utcnow(), **state)
+        _store().bump_version(level)
+        metrics.set_gauge('last_success_timestamp', time.time(), level)
+        return 'streamed'
+    t = mirror.read_latest(url) if replay else download_db(url, validators)
+    seconds = time.perf_counter() - start
+    logger.info(f"{level}: download={seconds:.2f}s")
+    metrics.set_gauge('download_seconds', seconds, level)
+    if t is None:
+        return 'failed'
+    if t is NOT_MODIFIED:
+        logger.info(f"{level}: not modified, skipped")
+        metrics.set_gauge('download_bytes', 0, level)
+        metrics.set_gauge('last_success_timestamp', time.time(), level)
+        return 'not-modified'
+    payload = t.encode('utf-8')
+    metrics.set_gauge('download_bytes', len(payload), level)
+    state['sha256'] = payload_digest(payload)
+    if SKIP_UNCHANGED and state['sha256'] == meta.get('sha256'):
+        logger.info(f"{level}: content unchanged, skipped")
+        if validators is not None:
+            save_meta(level, **validators)          # keep the validators fresh for the next run
+        if not columnar.exists(level, db_name=DB_NAME):
+            write_snapshot(level)
+        metrics.set_gauge('last_success_timestamp', time.time(), level)
+        return 'unchanged'
+    if validators is not None:
+        state.update(validators)
+    parse_q.put((level, t, meta if incremental else {}, state))  # blocks while the parser is behind
+    return 'queued'
+
+
+def _parse_stage(parse_q, upsert_q, results):
+    """Parses the payloads queued by `_fetch_stage` for `_upsert_stage`, records 'failed' in
+    `results` (level -> outcome) for those it could not parse
+    """
+    while True:
+        item = parse_q.get()
+        if item is _DONE:
+            upsert_q.put(_DONE)
+            return
+        level, t, meta, state = item
         try:
-            update_once()
+            start = time.perf_counter()
+            df = filter_db(t, level)
+            metrics.set_gauge('parse_rows', df.shape[0], level)
+            if 'date' in df.columns and len(df):
+                state['watermark'] = df['date'].max().to_pydatetime()
+                df = incremental_rows(df, meta.get('watermark'))
+            seconds = time.perf_counter() - start
+            logger.info(f"{level}: parse={seconds:.2f}s")
+            metrics.set_gauge('parse_seconds', seconds, level)
+            upsert_q.put((level, df, state))
         except Exception as e:
-            logger.warning("main loop worker ignores exception and continues: {}".format(e))
-        scheduler.enter(timeout, 1, _worker)    # schedule the next event
+            results[level] = 'failed'
+            logger.warning(f"{level}: parse stage ignores exception and continues: {e}")
+
 
-    scheduler.enter(0, 1, _worker)              # start the first event
-    scheduler.run(blocking=True)
+def _upsert_stage(upsert_q, results):
+    """Stores the frames queued by `_parse_stage`, records the outcome of every level in
+    `results`: 'upserted' once its rows, version, derived series, snapshot and metadata are
+    stored, else 'failed'
+    """
+    while True:
+        item = upsert_q.get()
+        if item is _DONE:
+            return
+        level, df, state = item
+        try:
+            start = time.perf_counter()
+            upsert_db(df, level)
+            # the rows are stored: readers reload `level` once they see the new version, and
+            # 'ready_at' releases `database.wait_ready`
+            version = _store().bump_version(level)
+            save_meta(level, ready_at=datetime.datetime.utcnow())
+            refresh_derived(level, df)
+            write_snapshot(level)
+            # the hash, watermark and validators advance last: should a step above fail, the
+            # next cycle does not skip the payload as unchanged and runs them again
+            save_meta(level, **state)
+            metrics.set_gauge('last_success_timestamp', time.time(), level)
+            results[level] = 'upserted'
+            logger.info(f"{level}: upsert={time.perf_counter() - start:.2f}s, version={version}")
+        except Exception as e:
+            results[level] = 'failed'
+            logger.warning(f"{level}: upsert stage ignores exception and continues: {e}")
+
+
+def update_once(incremental=INCREMENTAL, workers=DOWNLOAD_WORKERS, replay=REPLAY, levels=None):
+    """Runs one ingestion cycle over `levels` (all of `urls` by default) as a pipeline: up to
+    `workers` concurrent downloads feed a parse stage, which feeds an upsert stage, through queues
+    of `PIPELINE_QUEUE_SIZE`. With `replay`, sources are read from the on-disk mirror and the
+    network is never touched. Returns a `Counter` of level outcomes; a level queued for the
+    parse and upsert stages counts once they are done with it, as 'upserted' or 'failed'.
+    """
+    start = time.perf_counter()
+    _store().ensure_indexes()
+    parse_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upsert_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results = {}                    # level -> outcome in the parse and upsert stages
+    stages = [threading.Thread(target=_parse_stage, args=(parse_q, upsert_q, results)),
+              threading.Thread(target=_upsert_stage, args=(upsert_q, results))]
+    for stage in stages:
+        stage.start()
+    fetched = {}                    # level -> outcome in the download stage
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {level: pool.submit(_fetch_stage, level, url, incremental, replay, parse_q)
+                       for level, url in urls.items() if levels is None or level in levels}
+            for level, future in futures.items():
+                try:
+                    fetched[level] = future.result()
+                except Exception as e:
+                    fetched[level] = 'failed'
+                    logger.warning(f"{level}: download stage ignores exception and continues: {e}")
+    finally:
+        parse_q.put(_DONE)
+        for stage in stages:
+            stage.join()
+    # a queued level without a result never reached the end of the upsert stage
+    outcomes = Counter(results.get(level, 'failed') if outcome == 'queued' else outcome
+                       for level, outcome in fetched.items())
+    seconds = time.perf_counter() - start
+    logger.info(f"cycle={seconds:.2f}s, "
+                f"upserted={outcomes['upserted']}, unchanged={outcomes['unchanged']}, "
+                f"not_modified={outcomes['not-modified']}, "
+                f"failed={outcomes['failed']}")
+    if levels is None:
+        metrics.set_gauge('cycle_seconds', seconds)
+        if outcomes['failed'] == 0 and all(results.get(level) == 'upserted' for level, outcome
+                                           in fetched.items() if outcome == 'queued'):
+            # every queued level was confirmed stored by the upsert stage
+            metrics.set_gauge('last_success_timestamp', time.time())
+    else:
+        # a partial cycle, e.g. a single level run by `main_loop`: the data as a whole is only as
+        # fresh as the level whose last success is the oldest
+        succeeded = metrics.gauge('last_success_timestamp')
+        if all(level in succeeded for level in urls):
+            metrics.set_gauge('last_success_timestamp', min(succeeded[level] for level in urls))
+    if METRICS_JSON:
+        metrics.dump(METRICS_JSON)
+    return outcomes
+
+
+def main_loop(periods=None, replay=REPLAY):
+    """Refreshes every level of `urls` forever, each on its own period (see `UPDATE_PERIODS`)
+    """
+    periods = {level: (periods or UPDATE_PERIODS).get(level, DOWNLOAD_PERIOD) for level in urls}
+
+    def _run(level):
+        return update_once(replay=replay, levels=[level])['failed'] == 0
+
+    scheduler.LevelScheduler(_run, periods).run_forever()
 
 
 if __name__ == '__main__':
-    main_loop()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--replay', action='store_true',
+                        help='ingest from the on-disk mirror or bundled data/, no network')
+    parser.add_argument('--once', action='store_true', help='run a single cycle and exit')
+    parser.add_argument('--metrics-port', type=int, default=metrics.METRICS_PORT,
+                        help='port of the local metrics endpoint, 0 disables it')
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.once:
+        update_once(replay=args.replay)
+    else:
+        main_loop(replay=args.replay)
 
 
@@ -1,65 +1,544 @@
+import os
+import struct
 import logging
-import pymongo
+import datetime
+import numpy as np
 import pandas as pd
+import bson
 import expiringdict
 import time
+import threading
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import utils
+import columnar
+import storage
 
-client = pymongo.MongoClient()
+store = storage.get_storage('covid-us')      # backend from COVID_STORAGE, see `storage`
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'db.log')
 RESULT_CACHE_EXPIRATION = 3600 * 24          # seconds
+READ_BACKEND = os.environ.get('COVID_READ_BACKEND', 'mongo')    # 'mongo' or 'columnar'
+STARTUP_WORKERS = 7              # levels read concurrently by `fetch_all_db`
+READY_TIMEOUT = 600              # seconds an empty level waits for its first ingest
+READY_POLL = 0.5                 # seconds between checks of the ingestion metadata while waiting
+REFRESH_INTERVAL = 15 * 60       # seconds between background reloads of `DataRefresher`
+REFRESH_RETRY = 30               # seconds before retrying a failed reload, doubled per failure
+REFRESH_RETRY_MAX = 30 * 60      # cap of the failure backoff
+# weights of the mask use answers in the probability of wearing a mask, see `analysis`
+WEAR_MASK_WEIGHTS = {'RARELY': 0.25, 'SOMETIMES': 0.5, 'FREQUENTLY': 0.75, 'ALWAYS': 1.0}
+RAW_DECODE = True                # build Mongo frames from raw BSON batches, see `decode_raw_batches`
 
 levels = ['covid-us', 'covid-us-state', 'mask-use-by-county', 'state-population',
          'county-population', 'fips_code', 'state-area']
 
-def fetch_all_db():
-    db = client.get_database("covid-us")
-    ret_dict = {}
-    for level in levels:
-        length = 0
-        while length == 0:
-            collection = db.get_collection(level)
-            ret = list(collection.find())
-            ret_dict[level] = ret
-            length = len(ret)
-            if length == 0:
-                time.sleep(30)
-            logger.info(str(length) + ' documents read from the db')
-        time.sleep(1)
+load_timings = {}                # level -> seconds of the last `fetch_all_db` read, and 'total'
+
+
+def wait_ready(level, timeout=READY_TIMEOUT, poll=READY_POLL):
+    """Blocks until `data_acquire` has stored `level` at least once, i.e. its ingestion metadata
+    holds 'ready_at'. Returns False if that did not happen within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while store.get_meta(level).get('ready_at') is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll, remaining))
+    return True
+
+
+def _load_level(level, timeout, read):
+    start = time.perf_counter()
+    ret = read(level)
+    if len(ret) == 0:
+        logger.info(level + ' is empty, waiting for data_acquire')
+        if wait_ready(level, timeout):
+            ret = read(level)
+        else:
+            logger.warning(f"{level}: not ingested after {timeout}s, loaded empty")
+    load_timings[level] = time.perf_counter() - start
+    logger.info(f"{len(ret)} documents read from {level} in {load_timings[level]:.2f}s")
+    return ret
+
+
+def fetch_all_db(timeout=READY_TIMEOUT, workers=STARTUP_WORKERS, only=None, read=None):
+    """Reads every level (those of `only` if given) concurrently through `read` (level -> rows),
+    `store.fetch_level` by default. A level that is still empty waits (at most `timeout` seconds)
+    for `data_acquire` to mark it ready, see `wait_ready`. Per-level read times are logged and
+    kept in `load_timings`.
+    """
+    start = time.perf_counter()
+    store.ensure_indexes()
+    read = read or store.fetch_level
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {level: pool.submit(_load_level, level, timeout, read)
+                   for level in only or levels}
+        ret_dict = {level: future.result() for level, future in futures.items()}
+    load_timings['total'] = time.perf_counter() - start
+    logger.info(f"all levels read in {load_timings['total']:.2f}s")
     return ret_dict
 
 
-_fetch_all_db_as_df_cache = expiringdict.ExpiringDict(max_len=10,
+_BSON_DOUBLE, _BSON_STRING, _BSON_DATETIME, _BSON_INT32, _BSON_INT64 = 0x01, 0x02, 0x09, 0x10, 0x12
+_BSON_NUMBERS = {_BSON_INT32: '<i4', _BSON_INT64: '<i8', _BSON_DOUBLE: '<f8'}
+_MASKS = np.array([(1 << 8 * i) - 1 for i in range(9)], dtype=np.uint64)   # lowest i bytes
+_int32 = struct.Struct('<i')
+# unit pandas gives the datetimes decoded by pymongo, so both decoders build the same frame
+_DATETIME_DTYPE = pd.Series([datetime.datetime(2020, 1, 1)]).dtype
+
+
+class _Irregular(Exception):
+    """Documents do not share the flat layout `decode_raw_batches` decodes"""
+
+
+def _words(data):
+    """Returns the little-endian 8-byte word starting at every byte offset of `data`, which must
+    end with 8 bytes of padding: any field is then read at all documents with one gather
+    """
+    return np.ndarray((len(data) - 7,), dtype='<u8', buffer=data, strides=(1,))
+
+
+def _int32s(words, offsets):
+    return (words[offsets] & _MASKS[4]).astype(np.uint32).view(np.int32)
+
+
+def _matches(words, offsets, expected):
+    """Returns whether the bytes at every one of `offsets` equal `expected`"""
+    ok = np.ones(len(offsets), dtype=bool)
+    for k in range(0, len(expected), 8):
+        chunk = expected[k:k + 8]
+        ok &= (words[offsets + k] & _MASKS[len(chunk)]) == int.from_bytes(chunk, 'little')
+    return ok
+
+
+def _document_starts(data, n, words):
+    """Returns the offsets of the documents concatenated in the first `n` bytes of `data`.
+    Candidates are the offsets followed by the first element header of the first document; they
+    are the answer when they chain from 0 to `n` through their lengths, otherwise (a string value
+    happened to contain that header) the lengths are walked one document at a time.
+    """
+    header = data[4:data.index(b'\0', 5) + 1]
+    candidates = np.flatnonzero(np.frombuffer(data, dtype=np.uint8, count=n)[4:] == header[0])
+    candidates = candidates[candidates + 4 + len(header) <= n]      # the header fits in the data
+    candidates = candidates[_matches(words, candidates + 4, header)]
+    ends = candidates + _int32s(words, candidates)
+    if len(candidates) and candidates[0] == 0 and ends[-1] == n and \
+            (ends[:-1] == candidates[1:]).all():
+        return candidates
+    starts, pos = [], 0
+    while pos < n:
+        starts.append(pos)
+        pos += _int32.unpack_from(data, pos)[0]
+    return np.array(starts, dtype=np.int64)
+
+
+def _strings(data, words, offsets, lengths):
+    """Decodes the UTF-8 strings of `lengths` bytes at `offsets`. Strings are factorized 8 bytes at
+    a time into categorical codes, and each distinct string is decoded once.
+    """
+    codes = pd.factorize(lengths)[0]
+    last = len(words) - 1
+    for k in range(0, int(lengths.max()), 8):
+        chunk = words[np.minimum(offsets + k, last)] & _MASKS[np.clip(lengths - k, 0, 8)]
+        chunk_codes, chunk_uniques = pd.factorize(chunk)
+        codes = pd.factorize(codes * len(chunk_uniques) + chunk_codes)[0]
+    first = np.empty(codes.max() + 1, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    categories = np.array([data[o:o + l].decode('utf-8')
+                           for o, l in zip(offsets[first].tolist(), lengths[first].tolist())],
+                          dtype=object)
+    return categories[codes]
+
+
+def _decode_columns(data, n):
+    """Decodes the documents concatenated in the first `n` bytes of `data` (8 bytes of padding
+    follow), which must all hold the same flat fields in the same order, into one NumPy array
+    per field, field by field across all documents at once
+    """
+    words = _words(data)
+    starts = _document_starts(data, n, words)
+    ends = np.append(starts[1:], n)
+    pos = starts + 4
+    columns = {}
+    for key in bson.decode(data[:ends[0]]):
+        name = key.encode('utf-8') + b'\0'
+        if (pos + 1 + len(name) > ends).any() or not _matches(words, pos + 1, name).all():
+            raise _Irregular(f"field order differs at {key}")
+        types = np.frombuffer(data, dtype=np.uint8)[pos]
+        kinds = set(np.unique(types).tolist())
+        value = pos + 1 + len(name)
+        if kinds == {_BSON_STRING}:
+            length = _int32s(words, value).astype(np.int64)
+            columns[key] = _strings(data, words, value + 4, length - 1)
+            pos = value + 4 + length
+        elif kinds == {_BSON_DATETIME}:
+            millis = words[value].view('<i8')
+            columns[key] = millis.astype('datetime64[ms]').astype(_DATETIME_DTYPE)
+            pos = value + 8
+        elif kinds <= set(_BSON_NUMBERS):
+            values = np.empty(len(starts), dtype='f8' if _BSON_DOUBLE in kinds else 'i8')
+            for kind in kinds:
+                rows = types == kind
+                if kind == _BSON_INT32:
+                    values[rows] = _int32s(words, value[rows])
+                else:
+                    values[rows] = words[value[rows]].view(_BSON_NUMBERS[kind])
+            columns[key] = values
+            pos = value + np.where(types == _BSON_INT32, 4, 8)
+        else:
+            raise _Irregular(f"unsupported BSON types {kinds} in {key}")
+    if not columns or not (pos + 1 == ends).all():
+        raise _Irregular("documents hold extra or no fields")
+    return columns
+
+
+def decode_raw_batches(batches):
+    """Returns the `DataFrame` of the raw BSON `batches` of a `find_raw_batches` cursor, equal to
+    `columnar.frame_from_documents` of the decoded documents, without allocating a dict per
+    document. Dates, numbers and strings are decoded straight into NumPy columns; documents of
+    any other layout fall back to the regular decoder.
+    """
+    data = b''.join([*batches, bytes(8)])
+    n = len(data) - 8
+    if n == 0:
+        return columnar.frame_from_documents([])
+    try:
+        df = pd.DataFrame(_decode_columns(data, n))
+    except _Irregular as e:
+        logger.info(f"raw decode falls back to documents: {e}")
+        return columnar.frame_from_documents(bson.decode_all(data[:n]))
+    except Exception as e:
+        logger.warning(f"raw decode ignores exception and falls back to documents: {e!r}")
+        return columnar.frame_from_documents(bson.decode_all(data[:n]))
+    df.columns = map(str.lower, df.columns)
+    return df
+
+
+def fetch_level_raw(level):
+    """Returns the whole `level` as a `DataFrame` decoded from raw BSON batches (Mongo only)
+    """
+    return decode_raw_batches(store.raw_batches(level))
+
+
+def _frame(documents, columns):
+    """Returns `documents` as a `DataFrame` with lower-case `columns`, also when there are none"""
+    if not documents:
+        return pd.DataFrame(columns=[c.lower() for c in columns])
+    return columnar.frame_from_documents(documents)
+
+
+def state_series(state, fields=('cases', 'deaths'), start=None, end=None,
+                 level='covid-us-state', batch_size=storage.QUERY_BATCH_SIZE):
+    """Returns the date-sorted `fields` of `state` dated within [`start`, `end`] (either bound
+    optional) from `level`, 'covid-us-state' or 'derived-us-state'. Served by the
+    (state, date) index; only the projected fields leave the server.
+    """
+    columns = ['date'] + list(fields)
+    documents = store.query_range(level, start, end, where={'state': state}, columns=columns,
+                                  batch_size=batch_size)
+    return _frame(documents, columns)
+
+
+def latest_state_snapshot(fields=('cases', 'deaths'), level='covid-us-state',
+                          batch_size=storage.QUERY_BATCH_SIZE):
+    """Returns `fields` of every state on the latest date of `level`, sorted by state.
+    The latest date is one index seek, its rows an equality scan of `upsert_key`.
+    """
+    columns = ['date', 'state'] + list(fields)
+    date = store.latest(level)
+    if date is None:
+        return _frame([], columns)
+    documents = store.query_range(level, date, date, columns=columns, batch_size=batch_size)
+    return _frame(documents, columns).sort_values('state', ignore_index=True)
+
+
+def mask_use_by_fips(prefix, fields=('never', 'rarely', 'sometimes', 'frequently', 'always'),
+                     batch_size=storage.QUERY_BATCH_SIZE):
+    """Returns the mask use `fields` of the counties whose FIPS code starts with `prefix`,
+    e.g. '44' for every county of Rhode Island, sorted by 'countyfp'. Served by `upsert_key`.
+    """
+    columns = ['COUNTYFP'] + [f.upper() for f in fields]
+    documents = store.query_prefix('mask-use-by-county', 'COUNTYFP', prefix, columns=columns,
+                                   batch_size=batch_size)
+    return _frame(documents, columns)
+
+
+def _level_frame(level):
+    """Returns the whole `level` read through `store`, for the pandas side of `_aggregate`"""
+    return _frame(store.fetch_level(level), [])
+
+
+def _aggregate(level, pipeline, columns, fallback):
+    """Runs `pipeline` on `level` inside mongod, returns `columns` of its result. Stores without
+    aggregation pipelines (SQLite) compute the same frame in pandas with `fallback()`.
+    """
+    if not hasattr(store, 'db'):
+        return fallback()[columns].reset_index(drop=True)
+    documents = list(store.db.get_collection(level).aggregate(pipeline))
+    return _frame(documents, columns)[columns]
+
+
+def _wear_mask_prob():
+    return {'$add': [{'$multiply': [w, '$' + col]} for col, w in WEAR_MASK_WEIGHTS.items()]}
+
+
+def _latest_by_state_stages(fields):
+    # sorted like the (state, date) index and grouped on its prefix with $first only: mongod
+    # answers it with a DISTINCT_SCAN, one index seek per state
+    return [
+        {'$sort': {'state': 1, 'date': -1}},
+        {'$group': {'_id': '$state', **{f: {'$first': '$' + f} for f in ('date',) + fields}}},
+        {'$sort': {'_id': 1}},
+    ]
+
+
+def aggregate_latest_by_state(fields=('fips', 'cases', 'deaths')):
+    """Returns `fields` of every state on its own latest date, computed inside mongod
+    """
+    def fallback():
+        df = _level_frame('covid-us-state').sort_values('date', kind='stable')
+        return df.drop_duplicates('state', keep='last').sort_values('state')
+
+    pipeline = _latest_by_state_stages(tuple(fields)) + [
+        {'$project': {'_id': 0, 'state': '$_id', 'date': 1, **{f: 1 for f in fields}}}]
+    return _aggregate('covid-us-state', pipeline, ['state', 'date'] + list(fields), fallback)
+
+
+def aggregate_mask_use_by_state():
+    """Returns the mean mask use answers and wear mask probability of the counties of every
+    state FIPS prefix ('fips'), computed inside mongod
+    """
+    import analysis
+
+    columns = ['NEVER'] + list(WEAR_MASK_WEIGHTS)
+
+    def fallback():
+        df = _level_frame('mask-use-by-county')
+        df['wear_mask_prob'] = analysis.wear_mask_prob(df)
+        df = df.groupby(df['countyfp'].str[:2])[['wear_mask_prob'] + [c.lower() for c in columns]]
+        return df.mean().rename_axis('fips').reset_index()
+
+    pipeline = [
+        {'$group': {'_id': {'$substrCP': ['$COUNTYFP', 0, 2]},
+                    'wear_mask_prob': {'$avg': _wear_mask_prob()},
+                    **{c.lower(): {'$avg': '$' + c} for c in columns}}},
+        {'$sort': {'_id': 1}},
+        {'$project': {'_id': 0, 'fips': '$_id', 'wear_mask_prob': 1,
+                      **{c.lower(): 1 for c in columns}}},
+    ]
+    return _aggregate('mask-use-by-county', pipeline,
+                      ['fips', 'wear_mask_prob'] + [c.lower() for c in columns], fallback)
+
+
+def mask_use_by_state_stages():
+    """Returns the pipeline on 'mask-use-by-county' of the mean wear mask probability of every
+    state name ('_id'), grouped like `analysis.build_state_analytics`: counties get the state
+    code of their first 'fips_code' row (an `upsert_key` seek each), those without one or of DC
+    are left out, and codes are named as by `lookup.state_names`
+    """
+    import lookup
+
+    names = {'$switch': {'branches': [{'case': {'$eq': ['$code', code]}, 'then': name}
+                                      for code, name in lookup.code_names().items() if code != 'DC'],
+                         'default': None}}
+    return [
+        {'$lookup': {'from': 'fips_code', 'localField': 'COUNTYFP', 'foreignField': 'fips',
+                     'as': 'code'}},
+        {'$project': {'code': {'$arrayElemAt': ['$code.state', 0]},
+                      'wear_mask_prob': _wear_mask_prob()}},
+        {'$project': {'state': names, 'wear_mask_prob': 1}},
+        {'$match': {'state': {'$ne': None}}},
+        {'$group': {'_id': '$state', 'wear_mask_prob': {'$avg': '$wear_mask_prob'}}},
+    ]
+
+
+def state_analytics_stages(date):
+    """Returns the pipeline on 'covid-us-state' of the rows of `date` (an `upsert_key` range)
+    joined with the population ('total') and 'area' of their state (`upsert_key` seeks)
+    """
+    return [
+        {'$match': {'date': date}},
+        {'$lookup': {'from': 'state-population', 'localField': 'state', 'foreignField': 'state',
+                     'as': 'population'}},
+        {'$unwind': '$population'},
+        {'$lookup': {'from': 'state-area', 'localField': 'state', 'foreignField': 'state',
+                     'as': 'area'}},
+        {'$unwind': '$area'},
+        {'$project': {'_id': 0, 'state': 1, 'date': 1, 'fips': 1, 'cases': 1, 'deaths': 1,
+                      'total': '$population.total', 'area': '$area.area'}},
+    ]
+
+
+def aggregate_state_analytics():
+    """Returns the inputs of the scatter and correlation matrices, the rows of
+    `analysis.build_state_analytics` before its ratios: every state on the latest date of
+    'covid-us-state' with its population ('total'), 'area' and the mean wear mask probability
+    of its counties. Two pipelines run inside mongod, one per side of the join: the latest rows
+    with their population and area, and the mask use per state; only their ~50 rows each are
+    merged here. States missing from any input are left out, as by the inner merges there.
+    """
+    import analysis
+
+    columns = ['state', 'date', 'fips', 'cases', 'deaths', 'total', 'area', 'wear_mask_prob']
+    date = store.latest('covid-us-state')
+    if date is None:
+        return _frame([], columns)
+
+    def fallback():
+        frames = {level: _level_frame(level) for level in analysis.STATE_ANALYTICS_LEVELS}
+        return analysis.build_state_analytics(frames).assign(date=date)
+
+    if not hasattr(store, 'db'):
+        return _aggregate('covid-us-state', None, columns, fallback).sort_values(
+            'state', ignore_index=True)
+    latest = _aggregate('covid-us-state', state_analytics_stages(date), columns[:-1], fallback)
+    mask_use = _aggregate('mask-use-by-county', mask_use_by_state_stages() + [
+        {'$project': {'_id': 0, 'state': '$_id', 'wear_mask_prob': 1}}],
+        ['state', 'wear_mask_prob'], fallback)
+    return latest.merge(mask_use, on='state').sort_values('state', ignore_index=True)
+
+
+def fetch_all_columnar(columns=None, only=None):
+    """Reads every level (those of `only` if given) from its memory-mapped columnar snapshot, only
+    the columns listed for it in `columns` (level -> list) if given. Returns None if any snapshot
+    is missing.
+    """
+    df_dict = {}
+    for level in only or levels:
+        df = columnar.read(level, (columns or {}).get(level))
+        if df is None:
+            return None
+        logger.info(str(len(df)) + ' rows read from the ' + level + ' snapshot')
+        df_dict[level] = df
+    return df_dict
+
+
+# level -> (data version, DataFrame); the expiration only backs up the versions
+_fetch_all_db_as_df_cache = expiringdict.ExpiringDict(max_len=len(levels),
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
+cache_stats = Counter()          # levels served cached ('hit'), uncached ('miss') or stale ('reload')
+loaded_versions = {}             # level -> data version of the frame last returned
 
 
 def fetch_all_db_as_df(allow_cached=False):
     """Converts list of dicts returned by `fetch_all_db` to DataFrame with ID removed
-    Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
-    `_fetch_all_db_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
+    Actual job is done in `_work`. When `allow_cached`, the data versions bumped by `data_acquire`
+    after every ingest are read in one query and only the levels whose version changed since
+    they were cached (or whose entry expired) are reloaded; otherwise every level is reloaded.
+    With `READ_BACKEND` 'columnar', levels are read from the snapshots written by `data_acquire`
+    instead, falling back to Mongo while any of them is missing.
     """
-    def _work():
-        ret_dict = fetch_all_db()
-        if len(ret_dict) == 0:
-            return None
-        df_dict = {}
-        for level, data in ret_dict.items():
-            df = pd.DataFrame.from_records(data)
-            df.drop('_id', axis=1, inplace=True)
-            df.columns = map(str.lower, df.columns)
+    def _work(names):
+        if READ_BACKEND == 'columnar':
+            df_dict = fetch_all_columnar(only=names)
+            if df_dict is not None:
+                return df_dict
+            logger.warning('columnar snapshots incomplete, falling back to mongo')
+        if RAW_DECODE and hasattr(store, 'raw_batches'):
+            return fetch_all_db(only=names, read=fetch_level_raw)
+        ret_dict = fetch_all_db(only=names)
+        return {level: columnar.frame_from_documents(data) for level, data in ret_dict.items()}
+
+    versions = store.get_versions(levels)
+    df_dict, stale = {}, []
+    for level in levels:
+        cached = _fetch_all_db_as_df_cache.get(level) if allow_cached else None
+        if cached is not None and cached[0] == versions[level]:
+            cache_stats['hit'] += 1
+            df_dict[level] = cached[1]
+        else:
+            cache_stats['miss' if cached is None else 'reload'] += 1
+            stale.append(level)
+    if stale:
+        logger.info('reloading ' + ', '.join(stale))
+        for level, df in _work(stale).items():
+            _fetch_all_db_as_df_cache[level] = (versions[level], df)
             df_dict[level] = df
-        return df_dict
+    loaded_versions.update(versions)
+    return {level: df_dict[level] for level in levels}
 
-    if allow_cached:
+
+# complete set of frames served together; `generation` increases with every swap
+Dataset = namedtuple('Dataset', ['frames', 'versions', 'generation', 'loaded_at'])
+
+
+class DataRefresher:
+    """Keeps a complete dataset current off the request path. Every `interval` seconds the levels
+    whose data version changed are reloaded into a new `Dataset` (see `fetch_all_db_as_df`), which
+    then replaces `dataset` in one reference assignment: readers that take `frames()` once per
+    request always see one consistent snapshot. Hooks added with `add_hook` run right after each
+    swap, e.g. to rebuild caches derived from the data. Failed reloads keep the current dataset
+    and are retried with exponential backoff.
+    """
+    def __init__(self, interval=REFRESH_INTERVAL, retry=REFRESH_RETRY, retry_max=REFRESH_RETRY_MAX):
+        self.interval = interval
+        self.retry = retry
+        self.retry_max = retry_max
+        self.dataset = None
+        self.hooks = []
+        self.failures = 0
+        self._lock = threading.Lock()       # one reload at a time
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_hook(self, hook):
+        """Calls `hook(dataset)` after every swap, and right away if a dataset is loaded"""
+        self.hooks.append(hook)
+        if self.dataset is not None:
+            self._call(hook, self.dataset)
+
+    def frames(self):
+        """Returns the frames (level -> DataFrame) of the current dataset"""
+        return self.dataset.frames
+
+    def _call(self, hook, dataset):
         try:
-            return _fetch_all_db_as_df_cache['cache']
-        except KeyError:
-            pass
-    ret = _work()
-    _fetch_all_db_as_df_cache['cache'] = ret
-    return ret
+            hook(dataset)
+        except Exception as e:
+            logger.warning(f"refresh hook {getattr(hook, '__name__', hook)} ignores exception "
+                           f"and continues: {e}")
+
+    def refresh(self):
+        """Builds a new dataset and swaps it in unless no level changed, returns whether it did
+        """
+        with self._lock:
+            start = time.perf_counter()
+            frames = fetch_all_db_as_df(allow_cached=True)
+            current = self.dataset
+            if current is not None and all(frames[level] is current.frames[level]
+                                           for level in levels):
+                return False
+            self.dataset = Dataset(frames, dict(loaded_versions),
+                                   current.generation + 1 if current else 1, time.time())
+            logger.info(f"dataset generation {self.dataset.generation} swapped in "
+                        f"{time.perf_counter() - start:.2f}s")
+            for hook in self.hooks:
+                self._call(hook, self.dataset)
+            return True
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.wait(delay):
+            try:
+                self.refresh()
+                self.failures, delay = 0, self.interval
+            except Exception as e:
+                self.failures += 1
+                delay = min(self.retry * 2 ** (self.failures - 1), self.retry_max)
+                logger.warning(f"refresh ignores exception and continues, retrying in {delay}s: {e}")
+
+    def start(self):
+        """Loads the first dataset unless one is loaded (blocking), then starts the daemon thread
+        """
+        if self.dataset is None:
+            self.refresh()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='data-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+"""
+Derived series materialized at ingest time for the national and per-state levels: daily new cases
+and deaths, their trailing 7-day averages, and rates per 100k residents from 'state-population'.
+`data_acquire` recomputes only the dates touched by an upsert and writes them to the collections
+of `targets`, so reads get ready-to-plot series.
+"""
+import datetime
+import pandas as pd
+
+WINDOW = 7                       # days of the trailing averages
+PER = 100000                     # rates are per `PER` residents
+
+# source level -> collection of its derived series, keyed like `sources.filters`
+targets = {
+    'covid-us': 'derived-us',
+    'covid-us-state': 'derived-us-state',
+}
+
+
+def compute(df, population=None, window=WINDOW):
+    """Returns the derived series of the cumulative counts in `df` ('date', 'cases', 'deaths' and
+    optionally 'state'). `population` has 'state' and 'total'; per-state rates use the total of
+    their state, national rates the sum over all states.
+    """
+    by = ['state'] if 'state' in df.columns else []
+    df = df.sort_values(by + ['date']).reset_index(drop=True)
+    grouped = df.groupby(by, observed=True, sort=False) if by else None
+    for col in ('cases', 'deaths'):
+        new = grouped[col].diff() if by else df[col].diff()
+        # first day of a series counts its cumulative total, as `utils.daily_increase` does
+        df[f'new_{col}'] = new.fillna(df[col]).astype('int64')
+        rolling = df.groupby(by, observed=True, sort=False)[f'new_{col}'] if by else df[f'new_{col}']
+        avg = rolling.rolling(window, min_periods=1).mean()
+        df[f'new_{col}_avg{window}'] = avg.reset_index(level=0, drop=True) if by else avg
+    if population is not None and len(population):
+        if by:
+            total = df['state'].astype(str).map(population.set_index('state')['total'])
+        else:
+            total = population['total'].sum()
+        for col in ('cases', 'deaths', f'new_cases_avg{window}', f'new_deaths_avg{window}'):
+            df[f'{col}_per_100k'] = df[col] / total * PER
+    return df
+
+
+def load(store, level, since=None, window=WINDOW):
+    """Reads the counts of `level` from `store` (see `storage`) needed to derive every date from
+    `since` on (all dates when None) and returns their derived series, restricted to those dates
+    """
+    start = None
+    if since is not None:
+        # the previous `window` days feed the first averages and the first daily difference
+        start = since - datetime.timedelta(days=window)
+    columns = ['date', 'cases', 'deaths']
+    if level == 'covid-us-state':
+        columns.append('state')
+    df = pd.DataFrame(store.query_range(level, start=start, columns=columns))
+    if df.empty:
+        return df
+    population = pd.DataFrame(store.fetch_level('state-population', columns=['state', 'total']))
+    df = compute(df, population, window)
+    if since is not None:
+        df = df[df['date'] >= since]
+    return df
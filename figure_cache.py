@@ -0,0 +1,155 @@
+"""
+Cache of the figures returned by the Dash callbacks of `app.py`.
+A figure is stored as its serialized JSON under (callback, inputs, data versions, code version),
+where the data versions are those of the levels the callback reads in the current
+`database.Dataset`: a new ingest of one of them changes the key, so stale figures are never
+served and are simply evicted. The code version is a digest of the module defining the callback
+and `CACHE_VERSION`, so figures cached on disk before a deploy that changed them are not
+served either. Entries live in an in-process LRU bounded by `MEMORY_MAX_BYTES` of JSON, backed by a
+directory (`CACHE_DIR`, bounded by `DISK_MAX_BYTES`) that every server worker on the host
+reads and writes, so a figure built by one worker is reused by the others.
+"""
+import os
+import json
+import time
+import hashlib
+import inspect
+import logging
+import functools
+import threading
+from collections import Counter, OrderedDict
+import plotly.io
+import utils
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+MEMORY_MAX_BYTES = 64 * 2 ** 20      # figure JSON kept per process
+DISK_MAX_BYTES = 512 * 2 ** 20       # figure JSON kept in `CACHE_DIR`, pruned oldest first
+CACHE_DIR = os.environ.get('COVID_FIGURE_CACHE', os.path.join('data', '.cache', 'figures'))
+CACHE_VERSION = 1                    # bump when figures change through code outside their module
+
+
+def _code_version(fn):
+    """Returns `CACHE_VERSION` and a digest of the source file of `fn`"""
+    with open(inspect.getsourcefile(fn), 'rb') as f:
+        return CACHE_VERSION, hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+class FigureCache:
+    """LRU cache of figure JSON keyed by (callback, inputs, data versions, code version), see the
+    module doc.
+    `cache_dir` None disables the disk tier.
+    """
+    def __init__(self, refresher, max_bytes=MEMORY_MAX_BYTES, cache_dir=CACHE_DIR,
+                 disk_max_bytes=DISK_MAX_BYTES):
+        self.refresher = refresher
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()     # key -> figure JSON, least recently used first
+        self.size = 0                    # bytes of JSON in `entries`
+        self.stats = Counter()           # 'memory' and 'disk' hits, 'miss'es, 'evict'ions
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.json')
+
+    def _remember(self, key, text):
+        if len(text) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                return
+            self.entries[key] = text
+            self.size += len(text)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evict'] += 1
+
+    def get(self, key):
+        """Returns the figure JSON of `key` from memory, else from disk, else None"""
+        with self._lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                self.stats['memory'] += 1
+                return text
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                with open(path) as f:
+                    text = f.read()
+                os.utime(path)           # the disk tier is pruned least recently used first
+            except OSError:
+                text = None
+            if text is not None:
+                with self._lock:
+                    self.stats['disk'] += 1
+                self._remember(key, text)
+                return text
+        with self._lock:
+            self.stats['miss'] += 1
+        return None
+
+    def put(self, key, text):
+        """Stores the figure JSON `text` under `key` in memory and on disk"""
+        self._remember(key, text)
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, path)        # readers of other workers never see a partial file
+            self._prune()
+        except OSError as e:
+            logger.warning(f"figure cache write ignores exception and continues: {e}")
+
+    def _prune(self):
+        files = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass                     # removed by another worker
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def cached(self, *levels):
+        """Decorates a callback reading `levels` of the dataset of `refresher`: its figure is
+        built once per (inputs, data versions of `levels`) and later served from the cache
+        """
+        def decorator(fn):
+            code_version = _code_version(fn)
+
+            @functools.wraps(fn)
+            def callback(*args, **kwargs):
+                versions = self.refresher.dataset.versions
+                key = (fn.__name__, args, tuple(sorted(kwargs.items())),
+                       tuple(versions.get(level) for level in levels), code_version)
+                text = self.get(key)
+                if text is None:
+                    start = time.perf_counter()
+                    text = plotly.io.to_json(fn(*args, **kwargs), validate=False)
+                    self.put(key, text)
+                    logger.info(f"{fn.__name__}{args} built in {time.perf_counter() - start:.2f}s, "
+                                f"{len(text)} bytes")
+                return json.loads(text)
+            return callback
+        return decorator
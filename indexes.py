@@ -0,0 +1,179 @@
+"""
+Indexes of the 'covid-us' Mongo database.
+Every level gets a unique compound index on its `filters` columns, which backs the upsert lookups
+of `data_acquire`, plus the secondary indexes used by reads. `ensure_indexes` is idempotent and
+runs at startup of both `data_acquire` and `database`; `verify` explains the hot queries.
+
+    python indexes.py ensure
+    python indexes.py verify     # exits 1 if any hot query does a COLLSCAN
+"""
+import sys
+import argparse
+import logging
+import pymongo
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+import utils
+from sources import filters
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+# secondary indexes used by reads, on top of the unique `filters` index of each level. Levels
+# whose `filters` start with 'date' need no separate date index: `upsert_key` serves date sorts
+# in either direction.
+secondary_indexes = {
+    'covid-us-state': [[('state', ASCENDING), ('date', DESCENDING)]],
+    'covid-us-county': [[('fips', ASCENDING), ('date', DESCENDING)]],
+    'derived-us-state': [[('state', ASCENDING), ('date', DESCENDING)]],
+}
+
+_ensured = set()            # databases whose indexes were already ensured by this process
+
+
+def index_models(level):
+    """Returns the `IndexModel`s of `level`
+    """
+    models = [IndexModel([(_, ASCENDING) for _ in filters[level]], unique=True, name='upsert_key')]
+    for keys in secondary_indexes.get(level, []):
+        models.append(IndexModel(keys, name='_'.join(f"{k}_{d}" for k, d in keys)))
+    return models
+
+
+def ensure_indexes(db, force=False):
+    """Creates the missing indexes of every level in `db`, once per process unless `force`.
+    A level whose existing documents violate its unique key is logged and left unindexed.
+    """
+    if db.name in _ensured and not force:
+        return
+    for level in filters:
+        try:
+            db.get_collection(level).create_indexes(index_models(level))
+        except OperationFailure as e:
+            logger.error(f"{level}: cannot create indexes: {e}")
+    _ensured.add(db.name)
+
+
+def forget(db_name):
+    """Makes the next `ensure_indexes` of `db_name` create its indexes again, e.g. after a drop"""
+    _ensured.discard(db_name)
+
+
+def hot_queries(db):
+    """Returns `(name, level, filter, sort)` of the queries that must be served by an index:
+    the upsert lookup of every non-empty level, the date-sorted reads and the FIPS prefix scan
+    of `database`
+    """
+    queries = []
+    for level in filters:
+        sample = db.get_collection(level).find_one()
+        if sample is None:
+            continue
+        queries.append((f'{level}:upsert', level, {_: sample[_] for _ in filters[level]}, None))
+        if 'date' in filters[level]:
+            queries.append((f'{level}:latest', level, {}, [('date', DESCENDING)]))
+        if level in ('covid-us-state', 'derived-us-state'):
+            queries.append((f'{level}:series', level, {'state': sample['state']},
+                            [('date', ASCENDING)]))
+        if level == 'mask-use-by-county':
+            queries.append((f'{level}:prefix', level,
+                            {'COUNTYFP': {'$regex': '^' + sample['COUNTYFP'][:2]}},
+                            [('COUNTYFP', ASCENDING)]))
+    return queries
+
+
+def hot_pipelines(db):
+    """Returns `(name, level, pipeline, scans)` of the aggregations whose stages must be served
+    by an index: the latest document of every state behind `database.aggregate_latest_by_state`,
+    and the joins of `database.aggregate_state_analytics`. With `scans`, the pipeline reads its
+    whole level by design and only its `$lookup`s are checked.
+    """
+    latest = db.get_collection('covid-us-state').find_one(sort=[('date', DESCENDING)])
+    if latest is None:
+        return []
+    return [
+        ('covid-us-state:latest-by-state', 'covid-us-state', [
+            {'$sort': {'state': ASCENDING, 'date': DESCENDING}},
+            {'$group': {'_id': '$state', 'date': {'$first': '$date'}}},
+        ], False),
+        ('covid-us-state:analytics', 'covid-us-state', [
+            {'$match': {'date': latest['date']}},
+            {'$lookup': {'from': 'state-population', 'localField': 'state',
+                         'foreignField': 'state', 'as': 'population'}},
+            {'$lookup': {'from': 'state-area', 'localField': 'state', 'foreignField': 'state',
+                         'as': 'area'}},
+        ], False),
+        ('mask-use-by-county:analytics', 'mask-use-by-county', [
+            {'$lookup': {'from': 'fips_code', 'localField': 'COUNTYFP', 'foreignField': 'fips',
+                         'as': 'code'}},
+        ], True),
+    ]
+
+
+def _lookup_scans(plan):
+    """Yields the foreign collection of every `$lookup` stage of an executionStats `explain()`
+    that scanned it (mongod 5.0+ reports `collectionScans` per `$lookup`)
+    """
+    if isinstance(plan, dict):
+        if '$lookup' in plan and plan.get('collectionScans'):
+            yield plan['$lookup']['from']
+        for value in plan.values():
+            yield from _lookup_scans(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _lookup_scans(value)
+
+
+def _stages(plan):
+    """Yields every stage name found in an `explain()` plan"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+def verify(db):
+    """Explains every hot query and pipeline of `db`, returns the names of those that do a COLLSCAN,
+    in a `$lookup` included
+    """
+    failures = []
+    for name, level, filter_, sort in hot_queries(db):
+        cursor = db.get_collection(level).find(filter_)
+        if sort:
+            cursor = cursor.sort(sort).limit(1)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = set(_stages(plan))
+        logger.info(f"{name}: {', '.join(sorted(stages))}")
+        if 'COLLSCAN' in stages:
+            failures.append(name)
+    for name, level, pipeline, scans in hot_pipelines(db):
+        plan = db.command('explain', {'aggregate': level, 'pipeline': pipeline, 'cursor': {}},
+                          verbosity='executionStats')
+        stages = set(_stages(plan))
+        lookup_scans = sorted(set(_lookup_scans(plan)))
+        logger.info(f"{name}: {', '.join(sorted(stages))}"
+                    + (f", $lookup COLLSCAN of {', '.join(lookup_scans)}" if lookup_scans else ''))
+        if ('COLLSCAN' in stages and not scans) or lookup_scans:
+            failures.append(name)
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['ensure', 'verify'])
+    parser.add_argument('--db', default='covid-us')
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient().get_database(args.db)
+    ensure_indexes(db)
+    if args.command == 'verify':
+        failures = verify(db)
+        if failures:
+            logger.error(f"COLLSCAN in: {', '.join(failures)}")
+            sys.exit(1)
@@ -0,0 +1,100 @@
+"""
+Lookup tables of county FIPS codes and state names, built once on first use.
+A county FIPS code indexes an array of row positions into the county table, so whole columns are
+mapped to their county, state code and state name with one vectorized gather; state names and
+codes map both ways through dicts equal to those of `utils`. Unknown values map as the former
+`utils` scans did: 'N/A' for a FIPS code, 'Others' for a state.
+"""
+import functools
+import numpy as np
+import pandas as pd
+
+import assets
+
+NOT_FOUND = 'N/A'                # county, state code and state name of an unknown FIPS code
+OTHERS = 'Others'                # state name or code of an unknown state
+_FIPS_SPACE = 100000             # 5-digit county FIPS codes
+
+
+@functools.lru_cache(maxsize=None)
+def _tables():
+    """Returns the row of every FIPS code in the county table (its last row for unknown codes),
+    the county table ('county', 'state_code', 'state'), and the state name -> code and
+    code -> name dicts
+    """
+    from utils import state_code_dict, state_map_dict
+
+    fips_code = assets.fips_code().drop_duplicates('fips')      # first match wins, as the scans did
+    counties = pd.DataFrame({
+        'county': fips_code['county'].to_numpy(dtype=object),
+        'state_code': fips_code['state'].to_numpy(dtype=object),
+        'state': fips_code['state'].map(state_map_dict).fillna(NOT_FOUND).to_numpy(dtype=object),
+    })
+    counties.loc[len(counties)] = [NOT_FOUND, NOT_FOUND, NOT_FOUND]
+    positions = np.full(_FIPS_SPACE, len(counties) - 1, dtype=np.int32)
+    positions[fips_code['fips'].astype(int).to_numpy()] = np.arange(len(fips_code), dtype=np.int32)
+    code_to_name = {}
+    for name, code in state_code_dict.items():
+        code_to_name.setdefault(code, name)     # the first name of a code, as `get_state_name` did
+    return positions, counties, dict(state_code_dict), code_to_name
+
+
+def _rows(fips):
+    """Returns the county table row of every code of `fips`; only 5-digit strings are known"""
+    positions, counties, _, _ = _tables()
+    fips = pd.Series(fips, copy=False).astype(str)
+    valid = ((fips.str.len() == 5) & fips.str.isdigit()).to_numpy()
+    rows = np.full(len(fips), len(counties) - 1, dtype=np.int32)
+    rows[valid] = positions[fips[valid].astype(int).to_numpy()]
+    return rows
+
+
+def map_fips(fips):
+    """Returns the 'county', 'state_code' and 'state' (name) of every county FIPS code of the
+    Series `fips`, as a `DataFrame` on the same index
+    """
+    fips = pd.Series(fips, copy=False)
+    _, counties, _, _ = _tables()
+    mapped = counties.take(_rows(fips))
+    mapped.index = fips.index
+    return mapped
+
+
+def state_codes(names):
+    """Returns the code of every state name of the Series `names`"""
+    _, _, name_to_code, _ = _tables()
+    return pd.Series(names, copy=False).map(name_to_code).fillna(OTHERS)
+
+
+def state_names(codes):
+    """Returns the name of every state code of the Series `codes`"""
+    _, _, _, code_to_name = _tables()
+    return pd.Series(codes, copy=False).map(code_to_name).fillna(OTHERS)
+
+
+def code_names():
+    """Returns the state code -> name dict of `state_names`"""
+    return dict(_tables()[3])
+
+
+def _row(fip):
+    positions, counties, _, _ = _tables()
+    if isinstance(fip, str) and len(fip) == 5 and fip.isdigit():
+        return positions[int(fip)]
+    return len(counties) - 1
+
+
+def fip_to_state(fip):
+    return _tables()[1]['state_code'].iat[_row(fip)]
+
+
+def fip_to_county(fip):
+    return _tables()[1]['county'].iat[_row(fip)]
+
+
+def state_code(name):
+    return _tables()[2].get(name, OTHERS)
+
+
+def state_name(code):
+    return _tables()[3].get(code, OTHERS)
@@ -0,0 +1,114 @@
+"""
+Ingestion metrics of the `data_acquire` worker.
+Gauges hold the latest value of a measurement, counters accumulate; both are optionally labelled
+by level. They are served by a local HTTP endpoint in Prometheus text format (`/metrics`) and as
+JSON (`/metrics.json`), and `dump` writes the JSON to disk.
+"""
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 9105
+METRICS_HOST = '127.0.0.1'
+PREFIX = 'covid_ingest_'
+
+descriptions = {
+    'download_bytes': 'Size of the last downloaded payload',
+    'download_seconds': 'Wall time of the last download (or stream) of a level',
+    'parse_seconds': 'Wall time of the last parse of a level',
+    'parse_rows': 'Rows of the last parsed frame of a level',
+    'upsert_seconds_total': 'Cumulative wall time spent upserting a level',
+    'upsert_matched_total': 'Cumulative documents matched (updated) by upserts',
+    'upsert_inserted_total': 'Cumulative documents inserted by upserts',
+    'cycle_seconds': 'Wall time of the last update_once cycle over every level',
+    'last_success_timestamp': 'Unix time a level (or, unlabelled, every level) last completed',
+}
+
+_lock = threading.Lock()
+_gauges = {}                # name -> {level: value}
+_counters = {}
+
+
+def set_gauge(name, value, level=None):
+    with _lock:
+        _gauges.setdefault(name, {})[level] = value
+
+
+def gauge(name):
+    """Returns a copy of the values of gauge `name` by level, None for the unlabelled one"""
+    with _lock:
+        return dict(_gauges.get(name, {}))
+
+
+def inc(name, value=1, level=None):
+    with _lock:
+        values = _counters.setdefault(name, {})
+        values[level] = values.get(level, 0) + value
+
+
+def snapshot():
+    """Returns a JSON-serializable copy of every metric, levels keyed by name ('' if unlabelled)
+    """
+    with _lock:
+        return {
+            'timestamp': time.time(),
+            'gauges': {n: {l or '': v for l, v in vs.items()} for n, vs in _gauges.items()},
+            'counters': {n: {l or '': v for l, v in vs.items()} for n, vs in _counters.items()},
+        }
+
+
+def prometheus_text():
+    """Returns every metric in the Prometheus text exposition format
+    """
+    lines = []
+    snap = snapshot()
+    for kind, metrics in (('gauge', snap['gauges']), ('counter', snap['counters'])):
+        for name in sorted(metrics):
+            full_name = PREFIX + name
+            if name in descriptions:
+                lines.append(f"# HELP {full_name} {descriptions[name]}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for level, value in sorted(metrics[name].items()):
+                label = f'{{level="{level}"}}' if level else ''
+                lines.append(f"{full_name}{label} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path):
+    """Writes `snapshot()` as JSON to `path`, through a temporary file replacing it at once:
+    concurrent cycles each write their own file and readers never see a partial one
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = prometheus_text(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass                # scrapes would otherwise flood stderr
+
+
+def serve(port=METRICS_PORT, host=METRICS_HOST):
+    """Serves the metrics from a daemon thread, returns the server
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,122 @@
+"""
+Compressed on-disk mirror of the sources in `data_acquire.urls`.
+Every successful download is kept as `MIRROR_DIR/<url key>/<fetch time>.csv.gz`, so ingestion and
+benchmarks can be replayed with no network. URLs of files bundled under `data/` fall back to them.
+"""
+import os
+import gzip
+import hashlib
+import datetime
+
+MIRROR_DIR = 'mirror'
+BUNDLED_DIR = 'data'
+MIRROR_KEEP = 5                  # snapshots kept per URL, oldest are pruned
+BUNDLED_PREFIX = 'https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/'
+_TIME_FORMAT = '%Y%m%dT%H%M%S%fZ'
+_SUFFIX = '.csv.gz'
+
+
+def _url_dir(url):
+    return os.path.join(MIRROR_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+
+
+class Tee:
+    """File-like wrapper that copies every chunk read from `source` into `sink`, the file
+    yielded by `snapshot`, so a streamed download is mirrored as it is parsed.
+    """
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sink.write(data)
+        return data
+
+
+class _Snapshot:
+    """Context manager that writes a new snapshot of `url` atomically: the file only becomes
+    visible to `latest_path` once the block exits without an exception.
+    """
+    def __init__(self, url, fetched_at=None):
+        fetched_at = fetched_at or datetime.datetime.utcnow()
+        self.dir = _url_dir(url)
+        self.url = url
+        self.path = os.path.join(self.dir, fetched_at.strftime(_TIME_FORMAT) + _SUFFIX)
+        self.tmp = self.path + '.tmp'
+
+    def __enter__(self):
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, 'url.txt'), 'w') as f:
+            f.write(self.url)
+        self.file = gzip.open(self.tmp, 'wb')
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.tmp)
+            return False
+        os.replace(self.tmp, self.path)
+        for old in snapshots(self.url)[:-MIRROR_KEEP]:
+            os.remove(old)
+        return False
+
+
+def snapshot(url, fetched_at=None):
+    """Returns a context manager yielding a binary sink for a new snapshot of `url`, see `Tee`
+    """
+    return _Snapshot(url, fetched_at)
+
+
+def save(url, text, fetched_at=None):
+    """Stores the downloaded `text` of `url` as a new snapshot, returns its path
+    """
+    s = snapshot(url, fetched_at)
+    with s as f:
+        f.write(text.encode('utf-8'))
+    return s.path
+
+
+def snapshots(url):
+    """Returns the snapshot paths of `url`, oldest first
+    """
+    d = _url_dir(url)
+    if not os.path.isdir(d):
+        return []
+    return sorted(os.path.join(d, f) for f in os.listdir(d) if f.endswith(_SUFFIX))
+
+
+def bundled_path(url):
+    """Returns the path of the copy of `url` bundled under `data/`, None if there is none
+    """
+    if not url.startswith(BUNDLED_PREFIX):
+        return None
+    path = os.path.join(BUNDLED_DIR, url[len(BUNDLED_PREFIX):])
+    return path if os.path.isfile(path) else None
+
+
+def latest_path(url):
+    """Returns the newest snapshot of `url`, else its bundled copy, else None
+    """
+    paths = snapshots(url)
+    return paths[-1] if paths else bundled_path(url)
+
+
+def open_latest(url):
+    """Opens `latest_path(url)` as a binary stream of the raw CSV, None if nothing is mirrored
+    """
+    path = latest_path(url)
+    if path is None:
+        return None
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def read_latest(url):
+    """Returns the text of `latest_path(url)`, None if nothing is mirrored
+    """
+    f = open_latest(url)
+    if f is None:
+        return None
+    with f:
+        return f.read().decode('utf-8')
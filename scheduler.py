@@ -0,0 +1,73 @@
+"""
+Per-level scheduler of the `data_acquire` worker.
+Every level runs on its own period with random jitter, on a small thread pool, so a slow or failing
+source never holds back the others. A level never overlaps with itself, and runs missed while it
+was busy (or while the process was down) collapse into a single catch-up run.
+"""
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+SCHEDULER_WORKERS = 3            # levels allowed to run at the same time
+JITTER = 0.05                    # fraction of a period added at random to every next run
+FAILURE_RETRY = 15 * 60          # seconds before a failed level is retried, capped by its period
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+class LevelScheduler:
+    """Runs `run(level)` for every level of `periods` (level -> seconds) on its own schedule.
+    `run` returns True on success; False or an exception retries the level after `FAILURE_RETRY`.
+    """
+    def __init__(self, run, periods, workers=SCHEDULER_WORKERS, jitter=JITTER):
+        self.run = run
+        self.periods = dict(periods)
+        self.jitter = jitter
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cond = threading.Condition()
+        self.running = set()
+        self.next_run = {level: time.time() for level in self.periods}
+
+    def _delay(self, level, succeeded):
+        period = self.periods[level]
+        delay = period if succeeded else min(FAILURE_RETRY, period)
+        return delay + random.uniform(0, self.jitter * delay)
+
+    def _job(self, level, scheduled):
+        succeeded = False
+        try:
+            succeeded = bool(self.run(level))
+        except Exception as e:
+            logger.warning(f"{level}: scheduled run ignores exception and continues: {e}")
+        with self.cond:
+            now = time.time()
+            # runs missed while busy collapse into one catch-up run, due right away
+            self.next_run[level] = max(scheduled + self._delay(level, succeeded), now)
+            self.running.discard(level)
+            self.cond.notify()
+        if not succeeded:
+            logger.warning(f"{level}: run failed, retrying at "
+                           f"{time.strftime('%H:%M:%S', time.localtime(self.next_run[level]))}")
+
+    def run_pending(self):
+        """Starts every due level that is not already running, returns seconds until the next
+        level is due (None when every level is running)
+        """
+        with self.cond:
+            now = time.time()
+            for level, due in self.next_run.items():
+                if due <= now and level not in self.running:
+                    self.running.add(level)
+                    self.pool.submit(self._job, level, due)
+            pending = [due for level, due in self.next_run.items() if level not in self.running]
+            return max(0, min(pending) - now) if pending else None
+
+    def run_forever(self):
+        with self.cond:
+            while True:
+                self.cond.wait(timeout=self.run_pending())  # woken early when a run completes
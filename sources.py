@@ -0,0 +1,50 @@
+"""
+Sources of the 'covid-us' database: where each level is downloaded from (`urls`) and the columns
+that identify one of its documents (`filters`), shared by ingestion, indexing and reads.
+"""
+
+urls = {
+    'covid-us': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us.csv",
+    'covid-us-state': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv",
+    'covid-us-county': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv",
+    'mask-use-by-county': "https://raw.githubusercontent.com/nytimes/covid-19-data/master/mask-use/mask-use-by-county.csv",
+    'state-population': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/PopulationState.csv",
+    'county-population': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/PopulationCounty.csv",
+    'fips_code': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/fips_code.csv",
+    'state-area': "https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/StateArea.csv",
+}
+
+filters = {
+    'covid-us': ['date'],
+    'covid-us-state': ['date', 'state'],
+    'covid-us-county': ['date', 'state', 'county'],     # county names repeat across states
+    'mask-use-by-county': ['COUNTYFP'],
+    'state-population': ['state'],
+    'county-population': ['county', 'state'],
+    'fips_code': ['fips', 'county'],                    # a few territory FIPS cover several places
+    'state-area': ['state'],
+    # materialized by `derived`, not downloaded
+    'derived-us': ['date'],
+    'derived-us-state': ['date', 'state'],
+}
+
+# Column types applied at parse time by `data_acquire.filter_db`. Counts are int32, repeated
+# labels categorical, FIPS codes strings zero-padded to 2 (state) or 5 (county) digits, and
+# 'date' columns are parsed with `DATE_FORMAT`. Bump `SCHEMA_VERSION` whenever a stored type
+# changes, so every level is reloaded once and documents of the old type are dropped.
+SCHEMA_VERSION = 1
+DATE_FORMAT = '%Y-%m-%d'
+
+schemas = {
+    'covid-us': {'date': 'date', 'cases': 'int32', 'deaths': 'int32'},
+    'covid-us-state': {'date': 'date', 'state': 'category', 'fips': 'fips2',
+                       'cases': 'int32', 'deaths': 'int32'},
+    'covid-us-county': {'date': 'date', 'county': 'category', 'state': 'category', 'fips': 'fips5',
+                        'cases': 'int32', 'deaths': 'int32'},
+    'mask-use-by-county': {'COUNTYFP': 'fips5', 'NEVER': 'float64', 'RARELY': 'float64',
+                           'SOMETIMES': 'float64', 'FREQUENTLY': 'float64', 'ALWAYS': 'float64'},
+    'state-population': {'state': 'str', 'total': 'int32'},
+    'county-population': {'county': 'str', 'state': 'category', 'total': 'int32'},
+    'fips_code': {'fips': 'fips5', 'county': 'str', 'state': 'category'},
+    'state-area': {'state': 'str', 'area': 'int32'},
+}
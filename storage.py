@@ -0,0 +1,421 @@
+"""
+Storage backends of the 'covid-us' levels.
+Both backends offer the same small interface: `upsert_batch`, `query_range`, `query_prefix`,
+`latest`, `fetch_level`, per-level ingestion metadata (`get_meta`/`set_meta`, and the data
+version bumped after every ingest, `bump_version`/`get_versions`) and index setup. `MongoStorage` is the
+production backend; `SQLiteStorage` is an embedded single-file alternative with primary keys on
+the `filters` columns, WAL mode and batched `executemany` upserts, so a single node, tests and
+benchmarks can run without mongod. Pick one with the COVID_STORAGE environment variable.
+"""
+import os
+import re
+import json
+import sqlite3
+import datetime
+import threading
+import pymongo
+from pymongo import ReplaceOne, UpdateOne
+
+import indexes
+from sources import filters
+
+STORAGE_BACKEND = os.environ.get('COVID_STORAGE', 'mongo')     # 'mongo' or 'sqlite'
+DEFAULT_DB = 'covid-us'
+SQLITE_DIR = '.'                 # SQLite databases are stored as `SQLITE_DIR/<db name>.sqlite`
+META_COLLECTION = '_meta'        # per-level ingestion state (watermark, validators, payload hash)
+UPSERT_BATCH_SIZE = 1000         # operations per `bulk_write` round trip / `executemany` call
+UPSERT_ORDERED = False           # unordered batches let mongod apply writes in parallel
+UPSERT_MODE = 'replace'          # 'replace' -> ReplaceOne, 'update' -> UpdateOne with $set
+QUERY_BATCH_SIZE = 1000          # documents per cursor round trip (rows per `fetchmany`) of reads
+
+
+def _upsert_ops(records, level, mode=UPSERT_MODE):
+    """Yields one upsert operation per record, keyed on the `filters` columns of `level`
+    """
+    for record in records:
+        filter_ = {_:record[_] for _ in filters[level]}     # locate the document if exists
+        if mode == 'update':
+            yield UpdateOne(filter_, {'$set': record}, upsert=True)
+        else:
+            yield ReplaceOne(filter_, record, upsert=True)
+
+
+def bulk_upsert(collection, records, level, batch_size=UPSERT_BATCH_SIZE,
+                ordered=UPSERT_ORDERED, mode=UPSERT_MODE):
+    """Sends `records` to `collection` through `bulk_write` in chunks of `batch_size`.
+    Returns `(update_count, insert_count)` summed over the bulk results.
+    """
+    update_count, insert_count = 0, 0
+    ops = []
+    for op in _upsert_ops(records, level, mode):
+        ops.append(op)
+        if len(ops) == batch_size:
+            result = collection.bulk_write(ops, ordered=ordered)
+            update_count += result.matched_count
+            insert_count += result.upserted_count
+            ops = []
+    if ops:
+        result = collection.bulk_write(ops, ordered=ordered)
+        update_count += result.matched_count
+        insert_count += result.upserted_count
+    return update_count, insert_count
+
+
+class MongoStorage:
+    """Levels are collections of the Mongo database `db_name`"""
+    def __init__(self, db_name=DEFAULT_DB, client=None):
+        self.client = client or pymongo.MongoClient()
+        self.db = self.client.get_database(db_name)
+
+    def upsert_batch(self, level, records, batch_size=UPSERT_BATCH_SIZE, ordered=UPSERT_ORDERED,
+                     mode=UPSERT_MODE):
+        """Upserts `records` keyed on `filters[level]`, returns `(update_count, insert_count)`
+        """
+        return bulk_upsert(self.db.get_collection(level), records, level,
+                           batch_size=batch_size, ordered=ordered, mode=mode)
+
+    def _find(self, level, query, columns, batch_size, sort=None):
+        projection = {'_id': 0}
+        projection.update({_: 1 for _ in columns or []})
+        cursor = self.db.get_collection(level).find(query, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort, 1)
+        return list(cursor)
+
+    def query_range(self, level, start=None, end=None, where=None, columns=None,
+                    batch_size=QUERY_BATCH_SIZE):
+        """Returns the documents of `level` dated within [`start`, `end`] (either bound optional)
+        that equal `where` (column -> value), only `columns` if given, sorted by date
+        """
+        query = dict(where or {})
+        if start is not None or end is not None:
+            query['date'] = {}
+            if start is not None:
+                query['date']['$gte'] = start
+            if end is not None:
+                query['date']['$lte'] = end
+        return self._find(level, query, columns, batch_size, sort='date')
+
+    def query_prefix(self, level, column, prefix, columns=None, batch_size=QUERY_BATCH_SIZE):
+        """Returns the documents of `level` whose string `column` starts with `prefix`, sorted by
+        `column`. The anchored regex is answered from the bounds of an index on `column`.
+        """
+        query = {column: {'$regex': '^' + re.escape(prefix)}}
+        return self._find(level, query, columns, batch_size, sort=column)
+
+    def latest(self, level, column='date'):
+        """Returns the largest `column` of `level`, None if it is empty
+        """
+        document = self.db.get_collection(level).find_one(
+            {}, {'_id': 0, column: 1}, sort=[(column, -1)])
+        return document.get(column) if document else None
+
+    def fetch_level(self, level, columns=None, batch_size=QUERY_BATCH_SIZE):
+        """Returns every document of `level`, only `columns` if given
+        """
+        return self._find(level, {}, columns, batch_size)
+
+    def raw_batches(self, level, columns=None, batch_size=QUERY_BATCH_SIZE):
+        """Returns a cursor over every document of `level` (only `columns` if given) that yields
+        each batch as undecoded BSON bytes, see `database.decode_raw_batches`
+        """
+        projection = {'_id': 0}
+        projection.update({_: 1 for _ in columns or []})
+        return self.db.get_collection(level).find_raw_batches({}, projection,
+                                                              batch_size=batch_size)
+
+    def delete_numeric(self, level, column):
+        """Deletes the documents of `level` whose `column` is a number, returns their count
+        """
+        return self.db.get_collection(level).delete_many({column: {'$type': 'number'}}).deleted_count
+
+    def get_meta(self, level):
+        return self.db.get_collection(META_COLLECTION).find_one({'_id': level}) or {}
+
+    def set_meta(self, level, **fields):
+        self.db.get_collection(META_COLLECTION).update_one({'_id': level}, {'$set': fields},
+                                                           upsert=True)
+
+    def bump_version(self, level):
+        """Atomically increments the data version of `level`, returns the new version
+        """
+        meta = self.db.get_collection(META_COLLECTION).find_one_and_update(
+            {'_id': level}, {'$inc': {'version': 1}}, {'version': 1}, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+        return meta['version']
+
+    def get_versions(self, levels):
+        """Returns the data version of each of `levels` (0 if never ingested) in one query
+        """
+        found = self.db.get_collection(META_COLLECTION).find({'_id': {'$in': list(levels)}},
+                                                             {'version': 1})
+        versions = {meta['_id']: meta.get('version', 0) for meta in found}
+        return {level: versions.get(level, 0) for level in levels}
+
+    def ensure_indexes(self):
+        indexes.ensure_indexes(self.db)
+
+    def drop(self):
+        self.client.drop_database(self.db.name)
+        indexes.forget(self.db.name)                # the indexes went with the collections
+
+
+def _sql_type(value):
+    if isinstance(value, datetime.datetime):
+        return 'TIMESTAMP'
+    if isinstance(value, (bool, int)):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _to_sql(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')             # sorts and compares like the datetime
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def _json_hook(obj):
+    if set(obj) == {'$date'}:
+        return datetime.datetime.fromisoformat(obj['$date'])
+    return obj
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SQLiteStorage:
+    """Levels are tables of the SQLite file `path`, with a primary key on their `filters`
+    columns. Every thread gets its own connection; WAL mode lets readers run during ingestion.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {META_COLLECTION} '
+                         '(level TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def _columns(self, level):
+        """Returns the declared type of every column of `level`, empty if it has no table"""
+        rows = self._conn().execute(f'PRAGMA table_info({_quote(level)})').fetchall()
+        return {row[1]: row[2] for row in rows}
+
+    def _ensure_table(self, level, record):
+        """Creates the table of `level` after `record`, or adds the columns it lacks"""
+        conn = self._conn()
+        existing = self._columns(level)
+        if not existing:
+            cols = ', '.join(f'{_quote(k)} {_sql_type(v)}' for k, v in record.items())
+            keys = ', '.join(_quote(k) for k in filters[level])
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {_quote(level)} ({cols}, PRIMARY KEY ({keys}))')
+            for keys in indexes.secondary_indexes.get(level, []):
+                name = _quote(level + '_' + '_'.join(k for k, _ in keys))
+                cols = ', '.join(_quote(k) + (' DESC' if d < 0 else '') for k, d in keys)
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {_quote(level)} ({cols})')
+            return
+        for k, v in record.items():
+            if k not in existing:
+                conn.execute(f'ALTER TABLE {_quote(level)} ADD COLUMN {_quote(k)} {_sql_type(v)}')
+
+    def _existing(self, conn, level, keys):
+        """Returns how many of the distinct primary `keys` (tuples) are rows of `level`, probed
+        through the primary key in as few statements as the variable limit allows
+        """
+        width = len(filters[level])
+        per_probe = max(1, conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) // width)
+        row = '(' + ', '.join('?' for _ in range(width)) + ')'
+        columns = '(' + ', '.join(_quote(k) for k in filters[level]) + ')'
+        count = 0
+        for i in range(0, len(keys), per_probe):
+            chunk = keys[i:i + per_probe]
+            count += conn.execute(
+                f'SELECT COUNT(*) FROM {_quote(level)} WHERE {columns} IN '
+                f'(VALUES {", ".join(row for _ in chunk)})',
+                [value for key in chunk for value in key]).fetchone()[0]
+        return count
+
+    def upsert_batch(self, level, records, batch_size=UPSERT_BATCH_SIZE, **kwargs):
+        """Upserts `records` keyed on `filters[level]` with `INSERT .. ON CONFLICT DO UPDATE`
+        in `executemany` batches of `batch_size`, returns `(update_count, insert_count)`. The
+        keys of every batch are probed right before it is written, within the same write
+        transaction, so concurrent writers to other keys do not skew the counts.
+        """
+        if len(records) == 0:
+            return 0, 0
+        self._ensure_table(level, records[0])
+        cols = list(records[0])
+        updates = [c for c in cols if c not in filters[level]]
+        action = 'DO UPDATE SET ' + ', '.join(f'{_quote(c)}=excluded.{_quote(c)}' for c in updates) \
+            if updates else 'DO NOTHING'
+        sql = (f'INSERT INTO {_quote(level)} ({", ".join(_quote(c) for c in cols)}) '
+               f'VALUES ({", ".join("?" for _ in cols)}) '
+               f'ON CONFLICT ({", ".join(_quote(k) for k in filters[level])}) {action}')
+        key_positions = [cols.index(k) for k in filters[level]]
+        conn = self._conn()
+        insert_count = 0
+        with conn:                                  # one transaction for the whole frame
+            conn.execute('BEGIN IMMEDIATE')         # no other writer between probes and writes
+            for i in range(0, len(records), batch_size):
+                rows = [tuple(_to_sql(r.get(c)) for c in cols) for r in records[i:i + batch_size]]
+                # a key new to the table is inserted by its first row, later rows update it
+                keys = list({tuple(row[p] for p in key_positions) for row in rows})
+                insert_count += len(keys) - self._existing(conn, level, keys)
+                conn.executemany(sql, rows)
+        return len(records) - insert_count, insert_count
+
+    def _select(self, level, columns, where_sql='', params=(), order='',
+                batch_size=QUERY_BATCH_SIZE):
+        declared = self._columns(level)
+        if not declared:
+            return []
+        cols = [c for c in columns if c in declared] if columns else list(declared)
+        cursor = self._conn().execute(
+            f'SELECT {", ".join(_quote(c) for c in cols)} FROM {_quote(level)}{where_sql}{order}',
+            params)
+        timestamps = [i for i, c in enumerate(cols) if declared[c] == 'TIMESTAMP']
+        documents = []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return documents
+            for row in rows:
+                row = list(row)
+                for i in timestamps:
+                    if row[i] is not None:
+                        row[i] = datetime.datetime.fromisoformat(row[i])
+                documents.append(dict(zip(cols, row)))
+
+    def query_range(self, level, start=None, end=None, where=None, columns=None,
+                    batch_size=QUERY_BATCH_SIZE):
+        """Returns the rows of `level` dated within [`start`, `end`] (either bound optional)
+        that equal `where` (column -> value), only `columns` if given, sorted by date
+        """
+        clauses, params = [], []
+        for col, value in (where or {}).items():
+            clauses.append(f'{_quote(col)} = ?')
+            params.append(_to_sql(value))
+        if start is not None:
+            clauses.append('date >= ?')
+            params.append(_to_sql(start))
+        if end is not None:
+            clauses.append('date <= ?')
+            params.append(_to_sql(end))
+        where_sql = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return self._select(level, columns, where_sql, params, ' ORDER BY date', batch_size)
+
+    def query_prefix(self, level, column, prefix, columns=None, batch_size=QUERY_BATCH_SIZE):
+        """Returns the rows of `level` whose string `column` starts with `prefix`, sorted by
+        `column`. Written as a half-open range so the primary key or an index on `column` applies.
+        """
+        where_sql = f' WHERE {_quote(column)} >= ? AND {_quote(column)} < ?'
+        params = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else ('', '\U0010ffff')
+        return self._select(level, columns, where_sql, params, f' ORDER BY {_quote(column)}',
+                            batch_size)
+
+    def latest(self, level, column='date'):
+        """Returns the largest `column` of `level`, None if it is empty
+        """
+        declared = self._columns(level)
+        if column not in declared:
+            return None
+        value = self._conn().execute(
+            f'SELECT MAX({_quote(column)}) FROM {_quote(level)}').fetchone()[0]
+        if value is not None and declared[column] == 'TIMESTAMP':
+            return datetime.datetime.fromisoformat(value)
+        return value
+
+    def fetch_level(self, level, columns=None, batch_size=QUERY_BATCH_SIZE):
+        """Returns every row of `level`, only `columns` if given
+        """
+        return self._select(level, columns, batch_size=batch_size)
+
+    def delete_numeric(self, level, column):
+        """Deletes the rows of `level` whose `column` is a number, returns their count
+        """
+        if column not in self._columns(level):
+            return 0
+        with self._conn() as conn:
+            return conn.execute(f'DELETE FROM {_quote(level)} '
+                                f"WHERE typeof({_quote(column)}) IN ('integer', 'real')").rowcount
+
+    def get_meta(self, level):
+        row = self._conn().execute(f'SELECT doc FROM {META_COLLECTION} WHERE level = ?',
+                                   (level,)).fetchone()
+        return json.loads(row[0], object_hook=_json_hook) if row else {}
+
+    def set_meta(self, level, **fields):
+        with self._conn() as conn:
+            meta = self.get_meta(level)
+            meta.update(fields)
+            conn.execute(f'INSERT OR REPLACE INTO {META_COLLECTION} (level, doc) VALUES (?, ?)',
+                         (level, json.dumps(meta, default=_json_default)))
+
+    def bump_version(self, level):
+        """Atomically increments the data version of `level`, returns the new version
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')         # no other writer between read and write
+            meta = self.get_meta(level)
+            meta['version'] = meta.get('version', 0) + 1
+            conn.execute(f'INSERT OR REPLACE INTO {META_COLLECTION} (level, doc) VALUES (?, ?)',
+                         (level, json.dumps(meta, default=_json_default)))
+        return meta['version']
+
+    def get_versions(self, levels):
+        """Returns the data version of each of `levels` (0 if never ingested) in one query
+        """
+        levels = list(levels)
+        rows = self._conn().execute(
+            f"SELECT level, json_extract(doc, '$.version') FROM {META_COLLECTION} "
+            f'WHERE level IN ({", ".join("?" for _ in levels)})', levels).fetchall()
+        versions = {level: version for level, version in rows}
+        return {level: versions.get(level) or 0 for level in levels}
+
+    def ensure_indexes(self):
+        pass                # primary and secondary indexes are created with each table
+
+    def drop(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(db_name=DEFAULT_DB, backend=None):
+    """Returns the shared storage of database `db_name` on `backend` (`STORAGE_BACKEND` by default)
+    """
+    backend = backend or STORAGE_BACKEND
+    with _storages_lock:
+        if (backend, db_name) not in _storages:
+            if backend == 'sqlite':
+                store = SQLiteStorage(os.path.join(SQLITE_DIR, db_name + '.sqlite'))
+            elif backend == 'mongo':
+                store = MongoStorage(db_name)
+            else:
+                raise ValueError(f"unknown storage backend: {backend}")
+            _storages[(backend, db_name)] = store
+        return _storages[(backend, db_name)]
@@ -1,9 +1,16 @@
 import sys
 import logging
 import numpy as np
-import pandas as pd
 
-fips_code = pd.read_csv('https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/fips_code.csv', dtype={'fips' : str})
+import assets
+import lookup
+
+
+def __getattr__(name):
+    # `fips_code` is read from the bundled assets on first use, see `assets`
+    if name == 'fips_code':
+        return assets.fips_code()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def setup_logger(logger, output_file):
     logger.setLevel(logging.INFO)
@@ -54,20 +61,13 @@ def moving_average(data, window_size=7):
 
 
 
+# FIPS and state lookups are served by the tables of `lookup`; map whole columns with
+# `lookup.map_fips`, `lookup.state_codes` and `lookup.state_names` rather than row by row
 def fip_to_state(fip):
-    mask = (fips_code.fips == fip)
-    values = fips_code.loc[mask, 'state'].to_numpy()
-    if len(values) == 0:
-        return 'N/A'
-    else:
-        return values[0]
+    return lookup.fip_to_state(fip)
+
 def fip_to_county(fip):
-    mask = (fips_code.fips == fip)
-    values = fips_code.loc[mask, 'county'].to_numpy()
-    if len(values) == 0:
-        return 'N/A'
-    else:
-        return values[0]
+    return lookup.fip_to_county(fip)
     
 
 ### US state code
@@ -147,15 +147,12 @@ def correct_state_names(x):
     
 def get_state_codes(x):
     try:
-        return state_code_dict[x]
+        return lookup.state_code(x)
     except:
         return "Others"
     
 def get_state_name(x):
     try:
-        for name, code in state_code_dict.items():
-            if code == x:
-                return name
-        return 'Others'
+        return lookup.state_name(x)
     except:
         return "Others"
\ No newline at end of file